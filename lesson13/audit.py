@@ -41,15 +41,26 @@ def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
 
 
-def audit(osmfile):
+def audit(osmfile, streaming=True):
+    # With streaming, elements are audited on their "end" event and the tree is
+    # cleared after each node or way, so memory does not grow with the file
     osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+    if streaming:
+        context = ET.iterparse(osm_file, events=("start", "end"))
+        _, root = next(context)
+    else:
+        context = ET.iterparse(osm_file, events=("start",))
+    for event, elem in context:
 
         if elem.tag == "node" or elem.tag == "way":
+            if streaming and event == "start":
+                continue
             for tag in elem.iter("tag"):
                 if is_street_name(tag):
                     audit_street_type(street_types, tag.attrib['v'])
+            if streaming:
+                root.clear()
     osm_file.close()
     return street_types
 
@@ -14,10 +14,17 @@ import xml.etree.cElementTree as ET
 import pprint
 from collections import defaultdict
 
-def count_tags(filename):
+def count_tags(filename, streaming=True):
+    # With streaming the tree is cleared after each top level element, so
+    # memory does not grow with the file
     tags = defaultdict(int)
-    for event, elem in ET.iterparse(filename):
-        tags[elem.tag] += 1
+    context = ET.iterparse(filename, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end':
+            tags[elem.tag] += 1
+            if streaming and elem.tag in ('node', 'way', 'relation'):
+                root.clear()
     return tags
 
 def test():
@@ -31,6 +31,7 @@ problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
 
 def key_type(element, keys):
+    # the memoised version used by the project is tag_keys.key_type
     if element.tag == "tag":
         k = element.attrib['k']
         lowers = lower.search(k)
@@ -50,10 +51,17 @@ def key_type(element, keys):
 
 
 
-def process_map(filename):
+def process_map(filename, streaming=True):
+    # With streaming the tree is cleared after each top level element, so
+    # memory does not grow with the file
     keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(filename):
-        keys = key_type(element, keys)
+    context = ET.iterparse(filename, events=('start', 'end'))
+    _, root = next(context)
+    for event, element in context:
+        if event == 'end':
+            keys = key_type(element, keys)
+            if streaming and element.tag in ('node', 'way', 'relation'):
+                root.clear()
 
     return keys
 
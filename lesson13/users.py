@@ -15,11 +15,18 @@ def get_user(element):
     return
 
 
-def process_map(filename):
+def process_map(filename, streaming=True):
+    # With streaming the tree is cleared after each top level element, so
+    # memory does not grow with the file
     users = set()
-    for _, element in ET.iterparse(filename):
-        if element.attrib.get('user'):
-            users.add(element.attrib['user'])
+    context = ET.iterparse(filename, events=('start', 'end'))
+    _, root = next(context)
+    for event, element in context:
+        if event == 'end':
+            if element.attrib.get('user'):
+                users.add(element.attrib['user'])
+            if streaming and element.tag in ('node', 'way', 'relation'):
+                root.clear()
 
     return users
 
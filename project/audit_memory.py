@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Peak memory regression check of the streaming audits.
+
+A synthetic OSM file of SIZE_MB is generated (once, it is kept for the next
+runs) and every audit runs on it in its own process. The peak RSS of each
+process must stay under MAX_RSS_MB, which only holds if the audit releases
+the parsed elements as it goes.
+
+i.e python audit_memory.py            1 GB file
+    python audit_memory.py 200        200 MB file
+'''
+import os
+import sys
+import Queue
+import resource
+import traceback
+import multiprocessing
+
+import synthetic_osm
+
+LESSON13_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lesson13')
+SYNTHETIC_FILE = "synthetic_{}mb.osm"
+SIZE_MB = 1024
+MAX_RSS_MB = 200
+# seconds to wait for the result of one audit
+AUDIT_TIMEOUT = 3600
+
+# (module, function) of each audit to check
+AUDITS = [('dublin_openstreet', 'audit'),
+          ('osm_audit', 'run_audit'),
+          ('tag_keys', 'audit_keys'),
+          ('audit', 'audit'),
+          ('mapparser', 'count_tags'),
+          ('tags', 'process_map'),
+          ('users', 'process_map')]
+
+
+def run_audit(module_name, function_name, osm_file, queue):
+    ''' Run one audit and report the peak RSS of this process in MB, or the traceback if it fails'''
+    try:
+        if LESSON13_DIR not in sys.path:
+            sys.path.append(LESSON13_DIR)
+        module = __import__(module_name)
+        if function_name == 'run_audit':
+            module.run_audit(osm_file, module.default_visitors())
+        else:
+            getattr(module, function_name)(osm_file)
+    except Exception:
+        queue.put((None, traceback.format_exc()))
+        raise
+    # ru_maxrss is in KB on linux
+    queue.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, None))
+
+
+def peak_rss(module_name, function_name, osm_file, timeout=AUDIT_TIMEOUT):
+    ''' return: peak RSS in MB of the audit, run in a new process'''
+    name = "{}.{}".format(module_name, function_name)
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_audit, args=(module_name, function_name, osm_file, queue))
+    process.start()
+    try:
+        rss, error = queue.get(timeout=timeout)
+    except Queue.Empty:
+        rss, error = None, "no result after {}s".format(timeout)
+    if error is not None and process.is_alive():
+        process.terminate()
+    process.join()
+    if error is not None:
+        raise RuntimeError("Audit {} failed: {}".format(name, error))
+    if process.exitcode != 0:
+        raise RuntimeError("Audit {} failed with exit code {}".format(name, process.exitcode))
+    return rss
+
+
+def synthetic_file(size_mb):
+    path = SYNTHETIC_FILE.format(size_mb)
+    if not os.path.exists(path):
+        print "Generating {} ...".format(path)
+        synthetic_osm.generate(path, synthetic_osm.nodes_for_size(size_mb))
+    return path
+
+
+def test(size_mb=SIZE_MB, max_rss_mb=MAX_RSS_MB):
+    osm_file = synthetic_file(size_mb)
+    print "File: {} {}MB".format(osm_file, os.path.getsize(osm_file) >> 20)
+    failures = []
+    for module_name, function_name in AUDITS:
+        rss = peak_rss(module_name, function_name, osm_file)
+        print "{:<30} peak RSS {:>8.1f}MB".format("{}.{}".format(module_name, function_name), rss)
+        if rss > max_rss_mb:
+            failures.append(module_name)
+    assert not failures, "Peak RSS over {}MB: {}".format(max_rss_mb, ', '.join(failures))
+
+
+if __name__ == '__main__':
+    test(int(sys.argv[1]) if len(sys.argv) > 1 else SIZE_MB)
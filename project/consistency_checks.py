@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Consistency checks of the db, written in python when the SQL version of the
+query joins too many rows.
+
+street_mismatches returns the rows of the ways_vs_nodes query of queries.py:
+the street of every way next to each of its nodes with a different street.
+Instead of joining ways_nodes with nodes_tags and ways_tags twice, the streets
+of the ways and of the nodes are read into dictionaries (through the key index)
+and ways_nodes is scanned once in the order of its (id, position) index,
+looking up each node in the dictionaries, a hash join.
+'''
+from collections import defaultdict
+
+STREET_KEY = 'street'
+# Rows fetched at a time from the ways_nodes scan
+FETCH_SIZE = 10000
+STREET_MISMATCH_COLUMNS = ['node_id', 'node_value', 'way_id', 'way_value']
+
+
+def tag_values(connection, table, key):
+    ''' return: dictionary of element id and list of the values of its tags with key'''
+    values = defaultdict(list)
+    for element_id, value in connection.execute("select id, value from {} where key = ?".format(table), (key,)):
+        values[element_id].append(value)
+    return values
+
+
+def street_mismatches(connection, key=STREET_KEY, fetch_size=FETCH_SIZE):
+    ''' Nodes of each way whose street is not the street of the way, as queries.ways_vs_nodes
+        Every node is reported once per way, with each of its streets and each of the streets
+        of the way that differ. The rows are in way id and node position order.
+        param: connection to the db
+        return: rows, col_names
+    '''
+    way_streets = tag_values(connection, 'ways_tags', key)
+    node_streets = tag_values(connection, 'nodes_tags', key)
+    rows = []
+    current, seen = None, set()
+    cursor = connection.execute("select id, node_id from ways_nodes order by id, position")
+    while True:
+        batch = cursor.fetchmany(fetch_size)
+        if not batch:
+            break
+        for way_id, node_id in batch:
+            if way_id != current:
+                current, seen = way_id, set()
+            streets = way_streets.get(way_id)
+            if streets is None or node_id in seen:
+                continue
+            seen.add(node_id)
+            for node_value in node_streets.get(node_id, ()):
+                for way_value in streets:
+                    if way_value != node_value:
+                        rows.append((node_id, node_value, way_id, way_value))
+    return rows, list(STREET_MISMATCH_COLUMNS)
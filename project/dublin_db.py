@@ -1,9 +1,41 @@
 import sqlite3
 import csv
 from subprocess import call
+import os
 import re
+import time
+import Queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from way_geometry import build_way_geometry, GEOMETRY_TABLE
 
 TABLES = ['nodes', 'nodes_tags', 'ways', 'ways_tags', 'ways_nodes']
+# key/value table with the state of the db i.e the replication sequence of the last change applied
+METADATA_TABLE = 'metadata'
+# tables of summaries.sql read by the dashboard queries, kept up to date by triggers
+SUMMARY_TABLES = ['row_counts', 'tag_key_counts', 'street_counts', 'user_counts']
+# rtree virtual tables of spatial.sql with the nodes and the envelopes of the ways
+SPATIAL_TABLES = ['nodes_rtree', 'ways_rtree']
+
+# Pragmas used while bulk loading, trade durability for speed as the db can be rebuilt from the map
+LOAD_PRAGMAS = { 'journal_mode': 'OFF',
+                 'synchronous': 'OFF',
+                 'cache_size': -200000 }
+# Rows sent on each executemany and rows inserted per transaction
+BATCH_SIZE = 10000
+COMMIT_SIZE = 500000
+
+# Read only connections of ConnectionPool, the db file is memory mapped and each connection has its own page cache
+POOL_SIZE = 4
+MMAP_SIZE = 1 << 30
+CACHE_SIZE = -64000
+READ_PRAGMAS = { 'query_only': 'ON',
+                 'mmap_size': MMAP_SIZE,
+                 'cache_size': CACHE_SIZE }
+# Prepared statements kept by each connection, keyed by the sql text
+STATEMENT_CACHE_SIZE = 200
 
 class DB:
     def __init__(self, db_name):
@@ -19,7 +51,7 @@ class DB:
             'ways_tags': { 'fields': "(id, key, value, type)",
                            'values': '(?,?,?,?)' },
             'ways_nodes': { 'fields': "(id, node_id, position)",
-                            'values': '(?,?,?,?)' }
+                            'values': '(?,?,?)' }
         }
 
     def connect_to_db(self):
@@ -31,6 +63,16 @@ class DB:
                 self.connection = sqlite3.connect("{}.db".format(self.db_name))
             except Error as e:
                 print e
+        return self.connection
+
+    def set_pragmas(self, pragmas):
+        ''' It will set the pragmas passed by parameter on the current connection
+            param: pragmas dictionary of pragma name and value i.e LOAD_PRAGMAS
+        '''
+        self.connect_to_db()
+        cursor = self.connection.cursor()
+        for pragma, value in pragmas.iteritems():
+            cursor.execute("PRAGMA {} = {}".format(pragma, value))
 
     def drop_table_if_exist(self, table):
         ''' It will drop the table pass as argument only if exists
@@ -43,10 +85,28 @@ class DB:
         cursor.execute(drop_table_sql)
 
     def drop_all_tables(self):
-        ''' It will drop all the tables defined in TABLES array'''
-        for table in TABLES:
+        ''' It will drop all the tables defined in TABLES array, the metadata, summary, spatial and geometry tables'''
+        for table in TABLES + [METADATA_TABLE] + SUMMARY_TABLES + SPATIAL_TABLES + [GEOMETRY_TABLE]:
             self.drop_table_if_exist(table)
 
+    def create_metadata_table(self):
+        ''' It will create the metadata table if it does not exist yet'''
+        self.connect_to_db()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT)".format(METADATA_TABLE))
+
+    def get_metadata(self, key, default=None):
+        ''' return: value stored for key in the metadata table, default if there is none'''
+        self.create_metadata_table()
+        row = self.connection.execute("SELECT value FROM {} WHERE key = ?".format(METADATA_TABLE), (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_metadata(self, key, value):
+        ''' Store value for key in the metadata table, it is not committed
+            Call create_metadata_table before opening the transaction, creating a table commits it
+        '''
+        self.connection.execute("INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)".format(METADATA_TABLE),
+                                (key, str(value)))
+
     def create_tables(self, schemas_file='schema.sql'):
         ''' It will create the tables defined in the file you pass by parameter
             param: schemas_file containing the table(s) definition
@@ -67,6 +127,97 @@ class DB:
         command = "cat {} | sqlite3 {}.db".format(sqlite3_file, self.db_name)
         call(command, shell=True)
 
+    def insert_statement(self, table):
+        ''' Build the insert statement for the table based on self.tables definition'''
+        return "INSERT INTO {} {} VALUES {}".format(table, self.tables[table]['fields'],
+                                                     self.tables[table]['values'])
+
+    def create_indexes(self, indexes_file='indexes.sql'):
+        ''' It will build the indexes defined in the file you pass by parameter
+            Build them once the data is loaded so the inserts do not pay for index maintenance
+            param: indexes_file containing the index(es) definition
+        '''
+        self.connect_to_db()
+        with open(indexes_file) as f:
+            self.connection.executescript(f.read())
+
+    def create_summaries(self, summaries_file='summaries.sql'):
+        ''' It will (re)build the summary tables from the loaded rows and create the triggers
+            that keep them up to date on every later insert, delete and update
+            param: summaries_file containing the summary tables, their initial rows and the triggers
+        '''
+        self.connect_to_db()
+        with open(summaries_file) as f:
+            self.connection.executescript(f.read())
+        self.connection.commit()
+
+    def create_spatial_index(self, spatial_file='spatial.sql'):
+        ''' It will (re)build the rtree indexes of the nodes and of the way envelopes and create
+            the triggers that keep the nodes up to date. The envelopes are copied from the
+            way_geometry table, create_way_geometry must run first
+            param: spatial_file containing the rtree tables, their initial rows and the triggers
+        '''
+        self.connect_to_db()
+        with open(spatial_file) as f:
+            self.connection.executescript(f.read())
+        self.connection.commit()
+
+    def create_way_geometry(self, geometry_file='geometry.sql'):
+        ''' It will (re)create the way_geometry table and store the packed coordinates, bbox,
+            length and closedness of every way, see way_geometry.py
+            param: geometry_file containing the way_geometry table definition
+            return: number of ways
+        '''
+        self.connect_to_db()
+        with open(geometry_file) as f:
+            self.connection.executescript(f.read())
+        ways = build_way_geometry(self.connection)
+        self.connection.commit()
+        return ways
+
+    def has_tables(self, tables):
+        ''' return: True if every table of the list exists i.e SUMMARY_TABLES'''
+        self.connect_to_db()
+        found = self.connection.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name IN ({})".format(
+            ','.join('?' * len(tables))), tables).fetchone()[0]
+        return found == len(tables)
+
+    def analyze(self):
+        ''' Gather the statistics the query planner uses to pick the indexes'''
+        self.connect_to_db()
+        self.connection.execute("ANALYZE")
+        self.connection.commit()
+
+    def bulk_load(self, load=None, schemas_file='schema.sql', indexes_file='indexes.sql',
+                  summaries_file='summaries.sql', spatial_file='spatial.sql', geometry_file='geometry.sql'):
+        ''' It will create the tables, load the data and only then build the indexes,
+            the summary tables (with their triggers), the geometry of the ways, the
+            spatial index and run ANALYZE
+            param: load callable that loads the rows into the tables, insert_records by default
+            return: ordered dictionary with the seconds taken by each phase
+        '''
+        if load is None:
+            load = self.insert_records
+        phases = [('create_tables', lambda: self.create_tables(schemas_file)),
+                  ('load', load),
+                  ('create_indexes', lambda: self.create_indexes(indexes_file)),
+                  ('create_summaries', lambda: self.create_summaries(summaries_file)),
+                  ('create_geometry', lambda: self.create_way_geometry(geometry_file)),
+                  ('create_spatial', lambda: self.create_spatial_index(spatial_file)),
+                  ('analyze', self.analyze)]
+        self.timings = OrderedDict()
+        for phase, run in phases:
+            start = time.time()
+            run()
+            self.timings[phase] = time.time() - start
+        for phase, seconds in self.timings.iteritems():
+            print "{:<16} {:>8.1f}s".format(phase, seconds)
+        return self.timings
+
+    def read_pool(self, size=POOL_SIZE, pragmas=READ_PRAGMAS, statement_cache_size=STATEMENT_CACHE_SIZE):
+        ''' return: ConnectionPool of read only connections to this db'''
+        return ConnectionPool(self.db_name, size, pragmas, statement_cache_size)
+
     def close_connection(self):
         ''' Close the connection but first check if it's open'''
         if self.connection is not None:
@@ -86,3 +237,163 @@ class DB:
         rows = cursor.fetchall()
         col_names = [cn[0] for cn in cursor.description]
         return rows, col_names
+
+
+class Loader:
+    ''' Stream rows straight into the db tables, skipping the csv files.
+        Rows are buffered per table and sent with executemany every batch_size rows,
+        the transaction is committed every commit_size rows.
+    '''
+    def __init__(self, db, batch_size=BATCH_SIZE, commit_size=COMMIT_SIZE, pragmas=LOAD_PRAGMAS):
+        self.db = db
+        self.batch_size = batch_size
+        self.commit_size = commit_size
+        self.db.connect_to_db()
+        self.db.set_pragmas(pragmas)
+        self.statements = dict((table, db.insert_statement(table)) for table in TABLES)
+        self.buffers = dict((table, []) for table in TABLES)
+        self.rows = dict((table, 0) for table in TABLES)
+        self.seconds = dict((table, 0.0) for table in TABLES)
+        self.pending = 0
+        self.started = time.time()
+
+    def add(self, table, row):
+        ''' Buffer a row (tuple in table field order) and flush the table when the batch is full'''
+        buf = self.buffers[table]
+        buf.append(row)
+        if len(buf) >= self.batch_size:
+            self.flush(table)
+
+    def add_many(self, table, rows):
+        for row in rows:
+            self.add(table, row)
+
+    def flush(self, table):
+        ''' Send the buffered rows of table to the db'''
+        buf = self.buffers[table]
+        if not buf:
+            return
+        start = time.time()
+        self.db.connection.executemany(self.statements[table], buf)
+        self.seconds[table] += time.time() - start
+        self.rows[table] += len(buf)
+        self.pending += len(buf)
+        self.buffers[table] = []
+        if self.pending >= self.commit_size:
+            self.commit()
+
+    def commit(self):
+        self.db.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        ''' Flush every table and commit the last transaction
+            return: dictionary with rows, seconds and rows_per_sec for each table
+        '''
+        for table in TABLES:
+            self.flush(table)
+        self.commit()
+        return self.stats()
+
+    def stats(self):
+        stats = {}
+        for table in TABLES:
+            seconds = self.seconds[table]
+            stats[table] = { 'rows': self.rows[table],
+                             'seconds': seconds,
+                             'rows_per_sec': self.rows[table] / seconds if seconds else 0.0 }
+        return stats
+
+    def report(self):
+        ''' Print rows per second of each table'''
+        print "Loaded db:{}.db in {:.1f}s".format(self.db.db_name, time.time() - self.started)
+        for table, stat in sorted(self.stats().iteritems()):
+            print "{:<12} {:>12,d} rows {:>8.1f}s {:>12,.0f} rows/s".format(
+                table, stat['rows'], stat['seconds'], stat['rows_per_sec'])
+
+
+class ConnectionPool:
+    ''' Read only connections to the db, shared by several threads.
+        Connections are opened when needed up to size and reused, so the statements
+        prepared by each connection stay in its cache (keyed by the sql text) across queries.
+    '''
+
+    def __init__(self, db_name, size=POOL_SIZE, pragmas=READ_PRAGMAS, statement_cache_size=STATEMENT_CACHE_SIZE):
+        self.path = "{}.db".format(db_name)
+        if not os.path.exists(self.path):
+            raise IOError("db {} does not exist".format(self.path))
+        self.size = size
+        self.pragmas = pragmas
+        self.statement_cache_size = statement_cache_size
+        self.available = Queue.Queue()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        ''' Open a new read only connection, it can be used by any thread'''
+        connection = sqlite3.connect(self.path, check_same_thread=False,
+                                     cached_statements=self.statement_cache_size)
+        for pragma, value in self.pragmas.iteritems():
+            connection.execute("PRAGMA {} = {}".format(pragma, value))
+        return connection
+
+    def acquire(self):
+        ''' return: an idle connection, a new one if none is idle and the pool is not full,
+                    otherwise waits for one to be released
+        '''
+        try:
+            return self.available.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            if len(self.connections) < self.size:
+                connection = self.connect()
+                self.connections.append(connection)
+                return connection
+        return self.available.get()
+
+    def release(self, connection):
+        self.available.put(connection)
+
+    @contextmanager
+    def connection(self):
+        ''' i.e with pool.connection() as connection:'''
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    @contextmanager
+    def cursor(self, query_statement, parameters=()):
+        ''' Cursor of the query on a pooled connection, released at the end of the block
+            i.e with pool.cursor(statement) as cursor: cursor.fetchmany(1000)
+        '''
+        with self.connection() as connection:
+            cursor = connection.execute(query_statement, parameters)
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def execute_query(self, query_statement, parameters=(), limit=None):
+        ''' Execute the query on a pooled connection, as DB.execute_query
+            param: limit max rows to fetch, all if None
+            return: a list with the rows of the result, list with the column names
+        '''
+        with self.cursor(query_statement, parameters) as cursor:
+            if limit is None:
+                rows = cursor.fetchall()
+            else:
+                # fetchmany(0) would fetch every row
+                rows = cursor.fetchmany(limit) if limit > 0 else []
+            col_names = [cn[0] for cn in cursor.description]
+        return rows, col_names
+
+    def close(self):
+        ''' Close every connection, they must all be released'''
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+            self.available = Queue.Queue()
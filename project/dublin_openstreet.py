@@ -7,34 +7,53 @@ import cerberus
 import schema
 import csv
 import codecs
+import json
 import pprint
-from dublin_db import DB
+import os
+import shutil
+import time
+import tempfile
+import multiprocessing
+from dublin_db import DB, Loader, LOAD_PRAGMAS, BATCH_SIZE, COMMIT_SIZE
+from osm_shards import find_shards, ShardReader
+from fast_validator import FastValidator
+from osm_input import open_osm, is_compressed
+from osm_pbf import get_pbf_element, is_pbf
+from osm_columnar import ColumnarWriter, PATHS as COLUMNAR_PATHS
+from street_names import street_type_re, expected, MAPPING, street_type_of, NORMALISER, \
+    STREET_FIXES, build_street_fixes, merge_fix_stats, report_fixes
+from tag_keys import KEYS, merge_stats, report as report_keys
+from pipeline_metrics import Metrics, profiling, profile_file, merge_summaries, summary_snapshot, write_snapshot, \
+    report as report_metrics
 
 OSMFILE = "dublin.osm"
 DB_NAME = "dublin"
+# Number of processes used by process_map, 1 keeps the serial path
+WORKERS = multiprocessing.cpu_count()
+# Shards handed out per worker, more shards balance better across processes
+SHARDS_PER_WORKER = 4
+# 'csv' writes the csv(s) and imports them with sqlite3, 'direct' streams the rows into the db
+LOAD_MODE = 'csv'
+# Output of process_map: 'csv' or 'columnar' (Parquet with pyarrow, .npz row groups otherwise)
+OUTPUT_BACKEND = 'csv'
+# Rows buffered per csv before they are written with writerows
+WRITE_BATCH_SIZE = 10000
+# Seconds between the progress snapshots of process_map, None for the final one only
+PROGRESS_INTERVAL = 10
+# File to append the snapshots to as JSON lines, stderr if None
+METRICS_FILE = None
+# Profile process_map with 'cprofile' or 'sampling', the profiles are written next to the output
+PROFILER = None
+# Validate with the compiled schema checks, cerberus is only used to report the errors
+FAST_VALIDATION = True
+# Rewrite the addr:street values while shaping with the fixes of the names found by the audit
+CLEAN_STREETS = True
+STREET_KEY = "addr:street"
+# metadata key of the table of street fixes the db was loaded with, read by osm_changes
+STREET_FIXES_KEY = 'street_fixes'
 
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
-street_type_re = re.compile(r'\b\S+\.?\s\b\S+\.?$', re.IGNORECASE)
-
-# Expected Street types to map
-expected = ["Street Lower", "Street", "Street Crescent", "Street Upper", "Street West", "Street East", "Street South","Street Little","Street North",
-            "Avenue", "Avenue Upper", "Avenue Lower", "Place East", "Place West","Place Little", "Mews","Place South","Street Great", "Village", "Paddock",
-            "Boulevard", "Drive", "Court", "Place", "Square", "Square North", "Square West", "Square East","Square South", "Lane",
-            "Trail", "Parkway", "Commons", "Villas", "Terrace", "Cottages", "Park", "Quay", "Hill", "Grove", "Avenue Lower", "Place North",
-            "Road Upper", "Road Lower", "Road", "Road West", "Road North", "Road South", "Road East",
-            "Street Upper", "Lane South", "Lane East", "Lane North", "Lane West", "Lawn", "Lane Upper",
-            "Grove North", "Grove South", "Dock", "Quay Lower", "Quay Upper", "Crescent", "Gardens", "Mews End", "View", "Place Upper"]
-
-# If any mapping with the keys below appears we suggest a change to th values corresponding to that key
-MAPPING = { "St": "Street",
-            "St.": "Street",
-            "Rd.": "Road",
-            "Ave": "Avenue",
-            "Ln": "Lane",
-            "Rd": "Road"
-            }
-
 SCHEMA = schema.schema
 
 #files to write schemas to
@@ -43,6 +62,7 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+CSV_PATHS = [NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH]
 
 # Make sure the fields order in the csvs matches the column order in the sql table schema
 NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset', 'timestamp']
@@ -62,61 +82,62 @@ def audit_street_type(street_types, street_name):
         :param street_types: Set to update with unxpected street types
         :param street_name: street name to audit
     '''
-    m = street_type_re.search(street_name)
-    if m:
-        street_type = m.group()
-        split_street = street_type.split(' ')
-        if street_type in expected:
-            return
-        if (split_street[0] in expected and split_street[1] not in expected):
-            street_types[street_type].add(street_name)
+    street_type = street_type_of(street_name)
+    if street_type is not None:
+        street_types[street_type].add(street_name)
 
 def is_street_name(elem):
     ''' Validate if the k attrib is type addr:street'''
     return (elem.attrib['k'] == "addr:street")
 
-def audit(osmfile):
+def audit_street_names(street_types, elements, names=None):
+    ''' Audit the addr:street tags of the elements
+        param: street_types to update with unexpected street types
+        param: elements iterable of node or way elements
+        param: names set to add every distinct street name to, if not None
+    '''
+    for elem in elements:
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                audit_street_type(street_types, tag.attrib['v'])
+                if names is not None:
+                    names.add(tag.attrib['v'])
+
+def audit(osmfile, streaming=True, names=None):
     ''' Perform an audit on the file to parse
         It will iterate over the tree with Start events only and
         tag type node or way.
+        With streaming it will use the End events of node and way instead and
+        clear the tree after each of them as get_element does, so memory stays flat.
 
-        param: osmfile to audit
+        param: osmfile to audit, it can be compressed (.bz2, .gz, .xz) or .osm.pbf
+        param: names set to add every distinct street name to, to build the street fixes from
         return: a set of street types
     '''
-    osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
+    if streaming or is_pbf(osmfile):
+        audit_street_names(street_types, get_element(osmfile, tags=('node', 'way')), names)
+    else:
+        with open_osm(osmfile) as osm_file:
+            audit_street_names(street_types, (elem for event, elem in ET.iterparse(osm_file, events=("start",))
+                                              if elem.tag == "node" or elem.tag == "way"), names)
     print "finish audit"
     return street_types
 
 def update_name(name):
     ''' Update the name of the street based on MAPPING map defined above
+        Only the abbreviations of the street type at the end of the name are expanded
         param: name of the street to update
         return: suggested name
     '''
-    names = name.split(' ')
-    for idx, word in enumerate(names):
-        if MAPPING.get(word):
-            names[idx] = MAPPING[word]
-            break
-    nameit = ' '.join(names)
-    return nameit
+    return NORMALISER.normalise(name)
 
 def does_not_have_problemchars(element):
     ''' It will discard all tags with problematic charts defined in PROBLEMCHARS regex
         param: element to verify if contains problematic char
         return: True if does not contain problematic chars, False otherwise
     '''
-    k = element.attrib['k']
-    prob_chars = PROBLEMCHARS.search(k)
-    if prob_chars:
-        return False
-    return True
+    return not KEYS.classify(element.attrib['k']).problemchars
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS):
     """Clean and shape node or way XML element to Python dict"""
@@ -137,16 +158,29 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
         update_tags(element, way_tags, 'ways_tags')
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': way_tags}
 
+def shape_rows(element):
+    """ Low allocation shape_element, the rows are field ordered tuples and no dict is built
+        Values are the same shape_element gives, missing attributes are '' as the csv writer writes them
+        return: (node_row, node_tag_rows) for a node, (way_row, way_node_rows, way_tag_rows) for a way
+    """
+    if element.tag == 'node':
+        return attrib_row(element, NODE_FIELDS, 'node'), tag_rows(element)
+    elif element.tag == 'way':
+        return attrib_row(element, WAY_FIELDS, 'ways'), way_node_rows(element), tag_rows(element)
+
 def build_way_nodes(elem, way_nodes):
     ''' Build the way_nodes list of dictionaries
         param: elem to lookup the nd tag
         param: way_nodes list to update
     '''
-    pos_idx = 0
-    for nd in elem.iter('nd'):
-        if nd.attrib['ref']:
-            way_nodes.append({'id': elem.attrib.get('id'), 'node_id': nd.attrib.get('ref'), 'position': pos_idx })
-            pos_idx += 1
+    for way_id, node_id, position in way_node_rows(elem):
+        way_nodes.append({'id': way_id, 'node_id': node_id, 'position': position })
+
+def way_node_rows(elem):
+    ''' return: list of (id, node_id, position) of the nd tags of the way'''
+    way_id = elem.attrib.get('id')
+    refs = (nd.attrib['ref'] for nd in elem.iter('nd'))
+    return [(way_id, ref, position) for position, ref in enumerate(ref for ref in refs if ref)]
 
 def to_str(attr_key, attr_value, type):
     if attr_key in STRING_FIELDS[type]:
@@ -164,15 +198,39 @@ def scan_and_update_attribs(attr_fields, element, attribs, type):
         if element.attrib[attrib]:
             attribs[attrib] = to_str(attrib, element.attrib.get(attrib),type)
 
-def update_tags(element, tags, tag_type):
-    ''' build tags list according to the element that is being passed '''
+def attrib_row(element, attr_fields, type):
+    ''' Tuple of the attribute fields as scan_and_update_attribs shapes them, '' for the empty ones'''
+    attrib = element.attrib
+    return tuple(to_str(field, attrib[field], type) if attrib[field] else '' for field in attr_fields)
+
+def iter_tags(element):
+    ''' Yield key, value, type of the tags of the element without problematic chars
+        addr:street values are rewritten with the table loaded in STREET_FIXES
+    '''
     for tag in element.iter('tag'):
-        if tag.attrib['k'] and does_not_have_problemchars(tag):
-            key, type = split_key_type(tag.attrib['k'])
-            value = to_str('value', tag.attrib['v'], tag_type)
-            key = to_str('key', key, tag_type)
-            type = to_str('type', type, tag_type)
-            tags.append({ 'id' : element.attrib.get('id') , 'key': key, 'value': value, 'type': type})
+        k = tag.attrib['k']
+        if not k:
+            continue
+        key_class = KEYS.classify(k)
+        if not key_class.problemchars:
+            value = tag.attrib['v']
+            if k == STREET_KEY:
+                value = STREET_FIXES.fix(value)
+            yield key_class.key, value, key_class.type
+
+def update_tags(element, tags, tag_type):
+    ''' build tags list according to the element that is being passed'''
+    for key, value, type in iter_tags(element):
+        value = to_str('value', value, tag_type)
+        key = to_str('key', key, tag_type)
+        type = to_str('type', type, tag_type)
+        tags.append({ 'id' : element.attrib.get('id') , 'key': key, 'value': value, 'type': type})
+
+def tag_rows(element):
+    ''' return: list of (id, key, value, type) of the tags, utf-8 encoded as update_tags does'''
+    element_id = element.attrib.get('id')
+    return [(element_id, key.encode('utf-8'), value.encode('utf-8'), type.encode('utf-8'))
+            for key, value, type in iter_tags(element)]
 
 def split_key_type(elem, default_tag_type='regular'):
     ''' It will split the keys and key type based on the number of ":" it has
@@ -182,20 +240,28 @@ def split_key_type(elem, default_tag_type='regular'):
         param: key to evaluate and split
         return: key, type values
     '''
-    if elem.count(":") > 1:
-        splits = elem.split(":", 1)
-        # return key, type
-        return splits[1],splits[0]
-    elif elem.count(":") == 1:
-        splits = elem.split(":")
-        return splits[1], splits[0]
+    if ':' in elem:
+        key_class = KEYS.classify(elem)
+        return key_class.key, key_class.type
     return elem, default_tag_type
 
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
 def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+    """Yield element if it is the right type of tag
+       osm_file is a file object or a path, compressed paths are decompressed while parsed
+       and .osm.pbf paths are read with the PBF reader"""
+
+    if is_pbf(osm_file):
+        for elem in get_pbf_element(osm_file, tags):
+            yield elem
+        return
+    if isinstance(osm_file, basestring):
+        with open_osm(osm_file) as f:
+            for elem in get_element(f, tags):
+                yield elem
+        return
 
     context = ET.iterparse(osm_file, events=('start', 'end'))
     _, root = next(context)
@@ -213,6 +279,12 @@ def validate_element(element, validator, schema=SCHEMA):
 
         raise Exception(message_string.format(field, error_string))
 
+def new_validator(fast=FAST_VALIDATION):
+    """Validator to pass to validate_element, FastValidator or plain cerberus"""
+    if fast:
+        return FastValidator()
+    return cerberus.Validator()
+
 
 class UnicodeDictWriter(csv.DictWriter, object):
     """Extend csv.DictWriter to handle Unicode input"""
@@ -230,48 +302,306 @@ def update_street_type(element):
     audit(element)
 
 
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        validator = cerberus.Validator()
-
+def csv_row(record, fields):
+    """Tuple in fields order of a shaped record, unicode encoded and '' for missing fields as UnicodeDictWriter"""
+    return tuple((v.encode('utf-8') if isinstance(v, unicode) else v)
+                 for v in (record.get(field, '') for field in fields))
+
+
+class CSVWriter(object):
+    """ process_map output backend writing every table to a csv
+        Rows are field ordered tuples, buffered and written with csv.writer.writerows
+    """
+
+    def __init__(self, paths=CSV_PATHS, batch_size=WRITE_BATCH_SIZE):
+        self.files = [codecs.open(path, 'w') for path in paths]
+        self.writers = [csv.writer(f) for f in self.files]
+        self.batches = [[] for _ in paths]
+        self.nodes, self.nodes_tags, self.ways, self.ways_nodes, self.ways_tags = self.batches
+        self.batch_size = batch_size
+
+    def write_node(self, el):
+        self.write_node_rows(csv_row(el['node'], NODE_FIELDS),
+                             [csv_row(tag, NODE_TAGS_FIELDS) for tag in el['node_tags']])
+
+    def write_way(self, el):
+        self.write_way_rows(csv_row(el['way'], WAY_FIELDS),
+                            [csv_row(nd, WAY_NODES_FIELDS) for nd in el['way_nodes']],
+                            [csv_row(tag, WAY_TAGS_FIELDS) for tag in el['way_tags']])
+
+    def write_node_rows(self, node, tags):
+        self.nodes.append(node)
+        self.nodes_tags.extend(tags)
+        if len(self.nodes) >= self.batch_size:
+            self.flush()
+
+    def write_way_rows(self, way, way_nodes, tags):
+        self.ways.append(way)
+        self.ways_nodes.extend(way_nodes)
+        self.ways_tags.extend(tags)
+        if len(self.ways_nodes) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for writer, batch in zip(self.writers, self.batches):
+            writer.writerows(batch)
+            del batch[:]
+
+    def close(self):
+        self.flush()
+        for f in self.files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def merge(shard_paths, paths=CSV_PATHS):
+        merge_shards(shard_paths, paths)
+
+# writer class and default output paths of each OUTPUT_BACKEND
+BACKENDS = { 'csv': (CSVWriter, CSV_PATHS),
+             'columnar': (ColumnarWriter, COLUMNAR_PATHS) }
+
+
+def write_elements(file_in, validate, paths=None, backend=OUTPUT_BACKEND, metrics=None,
+                   profiler=None, profile_path=None, final=True):
+    """ Iteratively process each XML element of file_in and write it with the output backend
+        The elements, tags and way nodes and the seconds spent parsing, shaping, validating
+        and writing are counted in metrics, that prints a progress snapshot every interval.
+        param: paths output paths of the backend tables, the backend default ones if None
+        param: backend key of BACKENDS
+        param: metrics Metrics of the run, a new one with PROGRESS_INTERVAL and METRICS_FILE if None
+        param: profiler 'cprofile' or 'sampling' to profile the run, the profile is written to profile_path
+        param: final to print the final snapshot, the shards leave it to process_map
+    """
+    if metrics is None:
+        metrics = Metrics(interval=PROGRESS_INTERVAL, output=METRICS_FILE)
+    if isinstance(file_in, basestring) and not is_pbf(file_in):
+        # open it here to follow the bytes read, the size of compressed files is not known
+        if not is_compressed(file_in):
+            metrics.total_bytes = os.path.getsize(file_in)
+        with open_osm(file_in) as f:
+            return write_elements(f, validate, paths, backend, metrics, profiler, profile_path, final)
+    if hasattr(file_in, 'read'):
+        file_in = metrics.track(file_in)
+
+    writer_class, default_paths = BACKENDS[backend]
+    # the schema is checked on the shaped dicts, without validation rows are shaped as tuples
+    validator = new_validator() if validate else None
+    seconds = metrics.seconds
+    timer = time.time
+    with profiling(profiler, profile_path), writer_class(paths or default_paths) as writer:
+        start = timer()
         for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate:
-                    validate_element(el, validator)
+            parsed = timer()
+            if validate:
+                el = shape_element(element)
+                shaped = timer()
+                validate_element(el, validator)
+                validated = timer()
                 if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+                    writer.write_node(el)
+                    metrics.add(1, len(el['node_tags']))
+                else:
+                    writer.write_way(el)
+                    metrics.add(1, len(el['way_tags']), len(el['way_nodes']))
+            else:
+                rows = shape_rows(element)
+                shaped = validated = timer()
+                if element.tag == 'node':
+                    writer.write_node_rows(*rows)
+                    metrics.add(1, len(rows[1]))
+                else:
+                    writer.write_way_rows(*rows)
+                    metrics.add(1, len(rows[2]), len(rows[1]))
+            done = timer()
+            seconds['parse'] += parsed - start
+            seconds['shape'] += shaped - parsed
+            seconds['validate'] += validated - shaped
+            seconds['write'] += done - validated
+            start = done
+    if final:
+        metrics.emit(final=True)
+    return pipeline_stats(metrics)
+
+def pipeline_stats(metrics=None):
+    """Tag key cache and street fixes counters of this process, and the summary of metrics"""
+    stats = { 'keys': KEYS.stats(), 'streets': STREET_FIXES.stats() }
+    if metrics is not None:
+        stats['metrics'] = metrics.summary()
+    return stats
+
+def merge_pipeline_stats(all_stats):
+    """Add up the pipeline_stats of several worker processes"""
+    return { 'keys': merge_stats([stats['keys'] for stats in all_stats]),
+             'streets': merge_fix_stats([stats['streets'] for stats in all_stats]),
+             'metrics': merge_summaries([stats['metrics'] for stats in all_stats]) }
+
+def report_pipeline(stats):
+    report_keys(stats['keys'])
+    report_fixes(stats['streets'])
+    if 'metrics' in stats:
+        report_metrics(stats['metrics'])
+
+def process_shard(shard):
+    """Shape one byte range of the osm file into its own set of output files"""
+    idx, file_in, header, start, end, validate, paths, street_fixes, backend, monitor = shard
+    # pool processes run several shards, count the lookups and fixes of this one only
+    KEYS.reset_stats()
+    STREET_FIXES.reset_stats()
+    STREET_FIXES.load(street_fixes)
+    metrics = Metrics(idx, monitor['interval'], monitor['output'], total_bytes=end - start)
+    with ShardReader(file_in, start, end, header) as reader:
+        stats = write_elements(reader, validate, paths, backend, metrics,
+                               monitor['profiler'], profile_file(monitor['profile_dir'], monitor['profiler'], idx),
+                               final=False)
+    return paths, stats
+
+def merge_shards(shard_paths, paths=CSV_PATHS):
+    """ Concatenate the csv(s) of every shard in shard order into the final csv(s)
+        param: shard_paths list with the csv paths of each shard, in file order
+        param: paths final csv paths
+    """
+    for idx, path in enumerate(paths):
+        with open(path, 'wb') as out:
+            for shard in shard_paths:
+                with open(shard[idx], 'rb') as part:
+                    shutil.copyfileobj(part, out)
+
+def process_map(file_in, validate, workers=1, shards_per_worker=SHARDS_PER_WORKER, street_fixes=None,
+                backend=OUTPUT_BACKEND, interval=PROGRESS_INTERVAL, metrics_file=METRICS_FILE, profiler=PROFILER):
+    """ Iteratively process each XML element and write to csv(s), or to columnar files with backend 'columnar'
+        With workers > 1 the file is split on top level element boundaries and
+        every shard is shaped in a process pool. Shards are merged back in file
+        order, so the csv(s) are the same as the serial ones.
+        Compressed files can not be split by byte ranges, they are always shaped serially,
+        .osm.pbf files are decoded by a process pool in the PBF reader instead.
+        param: street_fixes dictionary of addr:street values and their fix, loaded in STREET_FIXES
+               (see build_street_fixes), the table already loaded is used if None
+        param: backend key of BACKENDS, the output is written to its default paths
+        param: interval seconds between the progress snapshots of each process, None for the final one only
+        param: metrics_file file to append the snapshots to as JSON lines, stderr if None
+        param: profiler 'cprofile' or 'sampling' to profile each process, see pipeline_metrics.profiling
+        return: dictionary with the tag key cache stats, street fixes counters and metrics summary,
+                summed over the workers
+    """
+    if street_fixes is not None:
+        STREET_FIXES.load(street_fixes)
+    writer_class, paths = BACKENDS[backend]
+    profile_dir = os.path.dirname(os.path.abspath(paths[0]))
+    if workers <= 1 or is_compressed(file_in) or is_pbf(file_in):
+        return write_elements(file_in, validate, backend=backend, metrics=Metrics(interval=interval, output=metrics_file),
+                              profiler=profiler, profile_path=profile_file(profile_dir, profiler))
+
+    monitor = { 'interval': interval, 'output': metrics_file, 'profiler': profiler, 'profile_dir': profile_dir }
+    header, ranges = find_shards(file_in, workers * shards_per_worker)
+    tmp_dir = tempfile.mkdtemp(prefix='shards_', dir=profile_dir)
+    try:
+        shards = []
+        for idx, (start, end) in enumerate(ranges):
+            shard_paths = [os.path.join(tmp_dir, "{}.{}".format(idx, os.path.basename(path)))
+                           for path in paths]
+            shards.append((idx, file_in, header, start, end, validate, shard_paths, STREET_FIXES.fixes,
+                           backend, monitor))
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(process_shard, shards, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        writer_class.merge([shard_paths for shard_paths, _ in results], paths)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    stats = merge_pipeline_stats([stats for _, stats in results])
+    # one final snapshot for the whole run, the shards send their counters back instead
+    write_snapshot(summary_snapshot(stats['metrics']), metrics_file)
+    return stats
+
+def to_row(record, fields):
+    ''' Build a tuple in fields order from a shaped record, ready to be inserted in the db
+        Missing fields are stored as an empty string as the csv writer does
+    '''
+    return tuple((v.decode('utf-8') if isinstance(v, str) else v)
+                 for v in (record.get(field, '') for field in fields))
+
+def stream_map(file_in, validate, db, pragmas=LOAD_PRAGMAS,
+               batch_size=BATCH_SIZE, commit_size=COMMIT_SIZE):
+    """ Iteratively process each XML element and insert it straight into the db tables
+        Rows per second of each table are printed at the end.
+        return: dictionary with the load stats per table
+    """
+    loader = Loader(db, batch_size=batch_size, commit_size=commit_size, pragmas=pragmas)
+    validator = new_validator()
+
+    for element in get_element(file_in, tags=('node', 'way')):
+        el = shape_element(element)
+        if el:
+            if validate:
+                validate_element(el, validator)
+            if element.tag == 'node':
+                loader.add('nodes', to_row(el['node'], NODE_FIELDS))
+                loader.add_many('nodes_tags', [to_row(tag, NODE_TAGS_FIELDS) for tag in el['node_tags']])
+            elif element.tag == 'way':
+                loader.add('ways', to_row(el['way'], WAY_FIELDS))
+                loader.add_many('ways_nodes', [to_row(nd, WAY_NODES_FIELDS) for nd in el['way_nodes']])
+                loader.add_many('ways_tags', [to_row(tag, WAY_TAGS_FIELDS) for tag in el['way_tags']])
+    stats = loader.close()
+    loader.report()
+    return stats
+
+def store_street_fixes(db, fixes=None):
+    ''' Keep the table of street fixes the db was loaded with in its metadata table, so the
+        change files are cleaned the same way
+        param: fixes dictionary of name and fixed name, the table loaded in STREET_FIXES if None
+    '''
+    db.create_metadata_table()
+    db.set_metadata(STREET_FIXES_KEY, json.dumps(STREET_FIXES.fixes if fixes is None else fixes))
+    db.connection.commit()
+
+def stored_street_fixes(db):
+    ''' return: table of street fixes kept by store_street_fixes, empty if the db has none'''
+    return json.loads(db.get_metadata(STREET_FIXES_KEY, '{}'))
+
+def load_map(file_in, validate, db_name=DB_NAME, **loader_args):
+    """ Recreate the db and stream the map into it, indexes are built once the rows are in
+        return: ordered dictionary with the seconds taken by each load phase
+    """
+    db = DB(db_name)
+    try:
+        timings = db.bulk_load(lambda: stream_map(file_in, validate, db, **loader_args))
+        store_street_fixes(db)
+        return timings
+    finally:
+        db.close_connection()
 
 if __name__ == '__main__':
     # let us first audit and update the dataset accordingly
-    st_types = audit(OSMFILE)
+    audited_names = set()
+    st_types = audit(OSMFILE, names=audited_names)
     for st_type, ways in st_types.iteritems():
         for name in ways:
             better_name = update_name(name)
             print name, "=>", better_name
-
-    # It will process the map that is defined on the top as OMSFILE
-    process_map(OSMFILE, validate=True)
-
-    # let's create the DB and generate the tables
-    dublin_db = DB(DB_NAME)
-    dublin_db.create_tables()
-    dublin_db.insert_records()
+    if CLEAN_STREETS:
+        # the fixes are applied once while shaping, no second pass over the db
+        STREET_FIXES.load(build_street_fixes(audited_names))
+
+    if LOAD_MODE == 'direct':
+        # Stream the map that is defined on the top as OMSFILE straight into the DB
+        load_map(OSMFILE, validate=True)
+        STREET_FIXES.report()
+    else:
+        # It will process the map that is defined on the top as OMSFILE
+        stats = process_map(OSMFILE, validate=True, workers=WORKERS)
+        report_pipeline(stats)
+
+        # let's create the DB, generate the tables and load them, indexes are built at the end
+        dublin_db = DB(DB_NAME)
+        dublin_db.bulk_load()
+        store_street_fixes(dublin_db)
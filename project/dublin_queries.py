@@ -5,24 +5,110 @@ import queries
 import argparse
 import textwrap
 import os
+import sys
+import csv
+import signal
+import json
+import time
+from functools import partial
+from multiprocessing.dummy import Pool as ThreadPool
+from contextlib import contextmanager
 
 from prettytable import from_db_cursor
 from prettytable import PrettyTable
-from collections import deque
+from collections import deque, OrderedDict
 
-from dublin_db import DB, TABLES
+from dublin_db import DB, TABLES, POOL_SIZE, READ_PRAGMAS, MMAP_SIZE, CACHE_SIZE
+from query_cache import QueryCache, db_fingerprint, CACHE_DIR, MAX_BYTES
+from consistency_checks import street_mismatches
+from osm_spatial import nodes_in_bbox, ways_in_bbox, nearest_nodes, nearest_ways, parse_tag, K
 from dublin_openstreet import NODES_PATH ,NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH
 from dublin_openstreet import expected
 
 DB_NAME = "dublin"
 QUERIES = queries.queries
 QUERY_ALL = "ALL"
-SPECIAL_QUERY = ["rows_per_table","street_types"]
+SPECIAL_QUERY = ["rows_per_table","street_types","ways_vs_nodes"]
+# Queries executed at the same time, each one on its own read only connection
+JOBS = 1
+# table prints the whole result with PrettyTable, the other formats print the rows
+# as they are fetched, FETCH_SIZE rows at a time, so memory does not grow with the result
+FORMAT = 'table'
+FORMATS = ['table', 'fixed', 'csv', 'jsonl']
+FETCH_SIZE = 1000
+# Widest column of the fixed format, longer values are cut
+MAX_WIDTH = 60
 
 class QUERY:
-    def __init__(self):
-        self.DB = DB(DB_NAME)
-        self.conn = self.DB.connect_to_db()
+    def __init__(self, db_name=DB_NAME):
+        self.DB = DB(db_name)
+        self.pool = None
+        self.cache = None
+
+    def use_cache(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        ''' Keep the results on disk, they are reused until the db file changes'''
+        self.cache = QueryCache(directory, max_bytes)
+        return self.cache
+
+    def connect(self, pool_size=POOL_SIZE, mmap_size=MMAP_SIZE, cache_size=CACHE_SIZE):
+        ''' Open the pool of read only connections the queries are executed on, they can run from several threads'''
+        pragmas = dict(READ_PRAGMAS, mmap_size=mmap_size, cache_size=cache_size)
+        self.pool = self.DB.read_pool(pool_size, pragmas)
+        return self.pool
+
+    def execute(self, statement, limit=None):
+        ''' Execute the statement on a pooled connection
+            param: statement sql, or a check called with the connection that returns rows, col_names
+            param: limit max rows to fetch, all if None
+            return: rows, col_names
+        '''
+        if self.pool is None:
+            self.connect()
+        if callable(statement):
+            with self.pool.connection() as connection:
+                rows, col_names = statement(connection)
+            return rows[:limit], col_names
+        return self.pool.execute_query(statement, limit=limit)
+
+    def cached(self, statement):
+        ''' return: rows, col_names of the statement from the cache, None if it is not cached'''
+        if self.cache is None:
+            return None
+        return self.cache.get(statement_key(statement), db_fingerprint("{}.db".format(self.DB.db_name)))
+
+    def fetch(self, statement, limit=None):
+        ''' Result of the statement from the cache if the db did not change since it was stored
+            Only whole results are stored, with a limit the rows are cut from the cached result
+            param: limit max rows to fetch, all if None
+            return: rows, col_names, True if the result comes from the cache
+        '''
+        result = self.cached(statement)
+        if result is not None:
+            rows, col_names = result
+            return rows[:limit], col_names, True
+        rows, col_names = self.execute(statement, limit)
+        if self.cache is not None and limit is None:
+            self.cache.put(statement_key(statement), db_fingerprint("{}.db".format(self.DB.db_name)), rows, col_names)
+        return rows, col_names, False
+
+    @contextmanager
+    def stream(self, statement, limit=None, fetch_size=FETCH_SIZE):
+        ''' Rows of the statement a batch at a time, from the cache if it has the result,
+            otherwise from a cursor on a pooled connection, held until the end of the block.
+            Streamed results are not stored in the cache, it would need every row in memory.
+            The rows of the checks are computed as a whole and then printed a batch at a time.
+            yield: col_names, iterator of lists of rows, True if the rows come from the cache
+        '''
+        result = self.cached(statement)
+        if result is not None or callable(statement):
+            rows, col_names = result if result is not None else self.execute(statement)
+            yield col_names, batches_of(rows, fetch_size, limit), result is not None
+            return
+        if self.pool is None:
+            self.connect()
+        with self.pool.cursor(statement) as cursor:
+            col_names = [cn[0] for cn in cursor.description]
+            yield col_names, fetch_batches(cursor, fetch_size, limit), False
 
     def print_description(self):
         return textwrap.dedent('''\
@@ -33,6 +119,11 @@ class QUERY:
          | - Update queries.py with new queries
          | - Pass the option --query_name to execute an specific query
          | - Execute multiple queries at once by passing --queries_names option
+         | - Execute the queries in parallel with --jobs N, results keep the order
+         | - Results are cached until the db changes, --no-cache to execute every query
+         | - Stream large results with --format fixed, csv or jsonl and cut them with --limit N
+         | - Find the nodes (or --ways) in an area with --bbox or the --k closest to a point with --near,
+         |   i.e --near 53.3498,-6.2603 --tag amenity=pub
          | Future Versions:
          | - Execute all queries
          |------------------------------------------------------------------
@@ -47,9 +138,36 @@ class QUERY:
         group.add_argument('--queries_names', dest='query_name', nargs='*',
                             help='Execute a list of queries separated by an space. i.e --queries_names a b c')
         group.add_argument('--query_name', dest='query_name', help='Execute a query defined in queries.py')
+        group.add_argument('--bbox', type=coordinates(4),
+                            help='Nodes inside min_lat,min_lon,max_lat,max_lon, ways with --ways')
+        group.add_argument('--near', type=coordinates(2), help='The --k nodes closest to lat,lon, ways with --ways')
+        parser.add_argument('--ways', action='store_true',
+                            help='--bbox and --near look for the ways, by their envelope, instead of the nodes')
+        parser.add_argument('--k', type=int, default=K, help='Number of nodes or ways returned by --near')
+        parser.add_argument('--tag', type=parse_tag, help='Tag the nodes or ways of --bbox and --near must have i.e amenity=pub')
+        parser.add_argument('--jobs', type=int, default=JOBS,
+                            help='Number of queries executed at the same time, results are printed in catalogue order')
+        parser.add_argument('--no-cache', dest='cache', action='store_false',
+                            help='Execute every query, without reading or storing results in the cache')
+        parser.add_argument('--cache_dir', default=CACHE_DIR, help='Directory of the results cache')
+        parser.add_argument('--cache_max_mb', type=int, default=MAX_BYTES >> 20,
+                            help='Size of the results cache, least recently used results are evicted first')
+        parser.add_argument('--format', dest='fmt', choices=FORMATS, default=FORMAT,
+                            help='table prints the whole result at once, fixed, csv and jsonl print the rows as '
+                                 'they are fetched. The titles and latencies of csv and jsonl go to stderr')
+        parser.add_argument('--limit', type=int, help='Max rows printed of each query')
+        parser.add_argument('--fetch_size', type=int, default=FETCH_SIZE,
+                            help='Rows fetched from the cursor at a time by the streaming formats')
+        parser.add_argument('--mmap_size', type=int, default=MMAP_SIZE,
+                            help='Bytes of the db memory mapped by each connection (PRAGMA mmap_size)')
+        parser.add_argument('--cache_size', type=int, default=CACHE_SIZE,
+                            help='Page cache of each connection, in pages or KiB if negative (PRAGMA cache_size)')
 
         args = parser.parse_args()
-        self.validate_args(args)
+        if isinstance(args.query_name, basestring):
+            args.query_name = [args.query_name]
+        if args.query_name is not None:
+            self.validate_args(args)
         return args
 
     def validate_args(self,args):
@@ -80,45 +198,134 @@ class QUERY:
         else:
             return None
 
-    def execute_queries(self,queries):
+    def execute_queries(self, queries, jobs=JOBS, fmt=FORMAT, limit=None, fetch_size=FETCH_SIZE):
         ''' Will execute each query on the "queries" list
            if the query is on SPECIAL_QUERY it will call the method defined over the script
-           else it will execute the regular query'''
+           else it will execute the regular query
+           With jobs > 1 the statements run in a pool of threads, each one on its own
+           read only connection, the results are printed in catalogue order as they are ready
+           The streaming formats (fixed, csv, jsonl) execute the queries one at a time,
+           as the rows are printed while they are fetched'''
+        if isinstance(queries, basestring):
+            queries = [queries]
         if QUERY_ALL in queries:
             queries = QUERIES.keys()
+        tasks = []
         for query in queries:
             if query in SPECIAL_QUERY:
-                getattr(self, query)(query)
+                tasks.extend(getattr(self, query)(query))
             else:
                 statement = self.retrieve_query(query)
                 if statement is not None:
-                    print "Executing query_name:{}\nQuery: {}".format(query,statement)
-                    rows, col_names = self.DB.execute_query(statement)
-                    print format_result(deque(col_names), rows)
+                    tasks.append(("Executing query_name:{}\nQuery: {}".format(query,statement), statement, format_result))
                 else:
-                    print "It looks like query: {} does not exist or it's disabled".format(query)
+                    tasks.append(("It looks like query: {} does not exist or it's disabled".format(query), None, None))
+        self.run_tasks(tasks, jobs, fmt, limit, fetch_size)
+
+    def run_tasks(self, tasks, jobs=JOBS, fmt=FORMAT, limit=None, fetch_size=FETCH_SIZE):
+        ''' Execute the tasks and print their results in order, as execute_queries'''
+        if fmt in STREAM_FORMATS:
+            for task in tasks:
+                self.stream_task(task, fmt, limit, fetch_size)
+        elif jobs > 1:
+            pool = ThreadPool(jobs)
+            try:
+                for output in pool.imap(lambda task: self.run_task(task, limit), tasks):
+                    print_output(output)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for task in tasks:
+                print_output(self.run_task(task, limit))
+
+    def run_task(self, task, limit=None):
+        ''' Execute the statement of the task and render its result
+            param: task tuple of title, statement (None to print the title only) and render(col_names, rows)
+            return: list with the parts of the output to print
+        '''
+        title, statement, render = task
+        if statement is None:
+            return [title]
+        start = time.time()
+        rows, col_names, cached = self.fetch(statement, limit)
+        latency = (time.time() - start) * 1000
+        return [title, render(deque(col_names), rows), format_latency(len(rows), latency, cached)]
+
+    def stream_task(self, task, fmt, limit=None, fetch_size=FETCH_SIZE, out=sys.stdout):
+        ''' Execute the statement of the task and print its rows in fmt as they are fetched
+            The tasks with their own render get the rows one at a time instead, in csv and
+            jsonl the rows of RENDER_ROWS are printed in place of the render.
+            The title and latency go to stderr for csv and jsonl, so out has the data only
+        '''
+        title, statement, render = task
+        info = out if fmt == 'fixed' else sys.stderr
+        print >> info, title
+        if statement is None:
+            return
+        start = time.time()
+        with self.stream(statement, limit, fetch_size) as (col_names, batches, cached):
+            if render is format_result:
+                count = STREAM_FORMATS[fmt](col_names, batches, out)
+            elif fmt == 'fixed':
+                counter = [0]
+                print >> out, render(deque(col_names), counted_rows(batches, counter))
+                count = counter[0]
+            else:
+                render_cols, render_rows = RENDER_ROWS[render]
+                count = STREAM_FORMATS[fmt](render_cols, [render_rows(row for batch in batches for row in batch)], out)
+        latency = (time.time() - start) * 1000
+        print >> info, format_latency(count, latency, cached)
 
     def rows_per_table(self, query):
-        ''' Will loop through the TABLES list and execute the same query for each table'''
-        for table in TABLES:
-            statement = self.retrieve_query(query)
-            if statement is not None:
-                st = statement.format(table)
-                rows, col_names = self.DB.execute_query(st)
-                print "Table: {}".format(table)
-                print format_result(deque(col_names), rows)
+        ''' Will loop through the TABLES list and execute the same query for each table
+            return: a task for each table
+        '''
+        statement = self.retrieve_query(query)
+        if statement is None:
+            return []
+        return [("Table: {}".format(table), statement.format(table), format_result) for table in TABLES]
 
     def street_types(self, query):
-        ''' Will loop in street types cursor and find uniqueness'''
-        st_types = set()
+        ''' Will loop in street types cursor and find uniqueness
+            return: the street types task
+        '''
+        statement = self.retrieve_query(query)
+        if statement is None:
+            return []
+        return [("Streets types", statement, format_street_types)]
+
+    def spatial_task(self, bbox=None, near=None, ways=False, k=K, tag=None):
+        ''' The task of a bbox lookup, or of a nearest one if near is not None, over the rtree
+            indexes of the nodes or of the way envelopes
+            param: bbox min_lat, min_lon, max_lat, max_lon
+            param: near lat, lon
+            param: tag (key, value) the nodes or ways must have
+            return: the task
+        '''
+        what = 'ways' if ways else 'nodes'
+        with_tag = " with {}={}".format(*tag) if tag is not None else ''
+        if near is not None:
+            lookup = partial(nearest_ways if ways else nearest_nodes, lat=near[0], lon=near[1], k=k, tag=tag)
+            title = "The {} {} closest to {},{}{}".format(k, what, near[0], near[1], with_tag)
+        else:
+            lookup = partial(ways_in_bbox if ways else nodes_in_bbox, bbox=tuple(bbox), tag=tag)
+            title = "The {} in {}{}".format(what, ','.join(map(str, bbox)), with_tag)
+        return (title, lookup, format_result)
+
+    def ways_vs_nodes(self, query):
+        ''' The streets of the nodes that differ from the street of their way, from the sql
+            of the catalogue (if enabled) and from the hash join of street_mismatches,
+            each one followed by its latency to compare them
+            return: the sql task and the check task
+        '''
+        tasks = []
         statement = self.retrieve_query(query)
         if statement is not None:
-            rows, col_names = self.DB.execute_query(statement)
-        for row in rows:
-            if row[0].split()[-1] in expected:
-                st_types.add(row[0].split()[-1])
-        print "Streets types"
-        print "\n".join(st_types)
+            tasks.append(("Executing query_name:{} (sql)\nQuery: {}".format(query, statement), statement, format_result))
+        tasks.append(("Executing query_name:{} (hash join over an ordered scan of ways_nodes)".format(query),
+                      street_mismatches, format_result))
+        return tasks
 
 
 def format_result(col_names, rows):
@@ -130,7 +337,7 @@ def format_result(col_names, rows):
         col_name = col_names.popleft()
         if len(col_names) == 0:
             # format(row[idx], ',d')
-            ptt.add_column(col_name, [ "{}".format(str(row[idx])) for row in rows])
+            ptt.add_column(col_name, [ u"{}".format(row[idx]) for row in rows])
             ptt.align[col_name]="r"
         else:
             ptt.add_column(col_name,[row[idx] for row in rows])
@@ -138,6 +345,136 @@ def format_result(col_names, rows):
         idx += 1
     return ptt
 
+def print_output(output):
+    for part in output:
+        print part
+
+def statement_key(statement):
+    ''' return: text identifying the statement in the cache, the module and name of a check
+                and the arguments of a partial one
+    '''
+    if isinstance(statement, partial):
+        return "{}{!r}{!r}".format(statement_key(statement.func), statement.args,
+                                   sorted((statement.keywords or {}).items()))
+    if callable(statement):
+        return "{}.{}".format(statement.__module__, statement.__name__)
+    return statement
+
+def coordinates(count):
+    ''' return: argparse type of count comma separated floats'''
+    def parse(value):
+        values = [float(part) for part in value.split(',')]
+        if len(values) != count:
+            raise argparse.ArgumentTypeError("expected {} comma separated numbers, got {}".format(count, value))
+        return values
+    return parse
+
+def format_latency(count, latency, cached):
+    return "{:,d} rows in {:.1f} ms{}".format(count, latency, ' (cached)' if cached else '')
+
+def fetch_batches(cursor, fetch_size=FETCH_SIZE, limit=None):
+    ''' Yield lists of at most fetch_size rows of the cursor, up to limit rows if not None'''
+    remaining = limit
+    while remaining is None or remaining > 0:
+        # fetchmany(0) would fetch every row, remaining > 0 here
+        batch = cursor.fetchmany(fetch_size if remaining is None else min(fetch_size, remaining))
+        if not batch:
+            return
+        if remaining is not None:
+            remaining -= len(batch)
+        yield batch
+
+def batches_of(rows, fetch_size=FETCH_SIZE, limit=None):
+    ''' Yield the rows of a list as fetch_batches does for a cursor'''
+    end = len(rows) if limit is None else min(limit, len(rows))
+    for start in xrange(0, end, fetch_size):
+        yield rows[start:min(start + fetch_size, end)]
+
+def counted_rows(batches, counter):
+    ''' Yield the rows of the batches one at a time, counter[0] is the number of rows yielded'''
+    for batch in batches:
+        counter[0] += len(batch)
+        for row in batch:
+            yield row
+
+def to_utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def fit(text, width):
+    ''' Cut text to width, the last character of a cut value is an ellipsis'''
+    if len(text) > width:
+        return text[:width - 1] + u'\u2026'
+    return text
+
+def stream_fixed(col_names, batches, out=sys.stdout):
+    ''' Print the rows in fixed width columns as they are fetched
+        The widths are those of the first batch (up to MAX_WIDTH), longer values of the
+        next batches are cut. Numbers are aligned to the right
+        return: number of rows printed
+    '''
+    count = 0
+    widths = None
+    for batch in batches:
+        if widths is None:
+            widths = [min(MAX_WIDTH, max([len(name)] + [len(u"{}".format(row[idx])) for row in batch]))
+                      for idx, name in enumerate(col_names)]
+            print >> out, to_utf8(u" ".join(fit(name, width).ljust(width) for name, width in zip(col_names, widths)).rstrip())
+            print >> out, " ".join('-' * width for width in widths)
+        for row in batch:
+            cells = []
+            for value, width in zip(row, widths):
+                text = fit(u"{}".format(value), width)
+                cells.append(text.rjust(width) if isinstance(value, (int, long, float)) else text.ljust(width))
+            print >> out, to_utf8(u" ".join(cells).rstrip())
+        count += len(batch)
+    if widths is None:
+        print >> out, to_utf8(u" ".join(col_names))
+    return count
+
+def stream_csv(col_names, batches, out=sys.stdout):
+    ''' Print the header and the rows as utf-8 csv as they are fetched
+        return: number of rows printed
+    '''
+    writer = csv.writer(out)
+    writer.writerow([to_utf8(name) for name in col_names])
+    count = 0
+    for batch in batches:
+        writer.writerows([to_utf8(value) for value in row] for row in batch)
+        count += len(batch)
+    return count
+
+def stream_jsonl(col_names, batches, out=sys.stdout):
+    ''' Print every row as a JSON object of the column names and values, one per line
+        return: number of rows printed
+    '''
+    count = 0
+    for batch in batches:
+        for row in batch:
+            out.write(json.dumps(OrderedDict(zip(col_names, row))) + '\n')
+        count += len(batch)
+    return count
+
+STREAM_FORMATS = { 'fixed': stream_fixed,
+                   'csv': stream_csv,
+                   'jsonl': stream_jsonl }
+
+def street_type_rows(rows):
+    ''' return: sorted rows of the expected street types found at the end of the street names'''
+    st_types = set()
+    for row in rows:
+        if row[0].split()[-1] in expected:
+            st_types.add(row[0].split()[-1])
+    return [(st_type,) for st_type in sorted(st_types)]
+
+def format_street_types(col_names, rows):
+    ''' It will print the expected street types found at the end of the street names'''
+    return "\n".join(st_type for st_type, in street_type_rows(rows))
+
+# col_names and rows of the renders of the tasks, for the csv and jsonl formats
+RENDER_ROWS = { format_street_types: (['street_type'], street_type_rows) }
+
 def print_file_size():
     ''' It will print the size of each file'''
     files = ['dublin.osm', NODES_PATH ,NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH]
@@ -154,11 +491,21 @@ def print_file_size():
 
 
 if __name__ == '__main__':
+    # end quietly when the reader of a stream goes away i.e | head, instead of an IOError
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
     queries = QUERY()
     args = queries.main()
+    queries.connect(pool_size=max(args.jobs, 1), mmap_size=args.mmap_size, cache_size=args.cache_size)
+    if args.cache:
+        queries.use_cache(args.cache_dir, args.cache_max_mb << 20)
 
-    # Get size of files
-    print_file_size()
+    # Get size of files, stdout is kept for the rows with csv and jsonl
+    if args.query_name is not None and args.fmt in ('table', 'fixed'):
+        print_file_size()
 
     # Now let's have fun executing queries
-    queries.execute_queries(args.query_name)
+    if args.query_name is not None:
+        queries.execute_queries(args.query_name, args.jobs, args.fmt, args.limit, args.fetch_size)
+    else:
+        task = queries.spatial_task(args.bbox, args.near, args.ways, args.k, args.tag)
+        queries.run_tasks([task], args.jobs, args.fmt, args.limit, args.fetch_size)
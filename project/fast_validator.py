@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Fast path for the cerberus validation of the shaped elements.
+
+The schema is compiled once into plain check-and-coerce functions, one per
+element type (node, node_tags, way, way_nodes, way_tags). Those functions
+only prove that an element is valid. Whenever they cannot, the element is
+handed to cerberus, so the result and the error messages raised through
+validate_element are exactly the cerberus ones.
+
+FastValidator has the same validate(document, schema) / errors interface as
+cerberus.Validator, so it can be passed to validate_element as it is.
+'''
+import sys
+import time
+
+import cerberus
+
+import schema
+
+SCHEMA = schema.schema
+
+# cerberus types we know how to check, any other type always goes to cerberus
+TYPES = { 'integer': (int, long),
+          'float': (float,),
+          'string': (basestring,),
+          'dict': (dict,),
+          'list': (list,) }
+SUPPORTED_RULES = frozenset(['type', 'schema', 'coerce', 'required'])
+
+
+class Invalid(Exception):
+    ''' Raised by the compiled checks when the element can not be proven valid'''
+
+
+def unsupported(value):
+    raise Invalid()
+
+
+def compile_rule(rule):
+    ''' Compile the rule of a field into a function that returns the coerced value
+        param: rule dictionary with the cerberus rules of the field
+        return: function(value) raising Invalid or the coercion error
+    '''
+    if not SUPPORTED_RULES.issuperset(rule) or rule.get('type') not in TYPES:
+        return unsupported
+
+    types = TYPES[rule['type']]
+    coerce = rule.get('coerce')
+    inner = None
+    if 'schema' in rule:
+        if rule['type'] == 'dict':
+            inner = compile_fields(rule['schema'])
+        elif rule['type'] == 'list':
+            item = compile_rule(rule['schema'])
+            inner = lambda values: [item(value) for value in values]
+        else:
+            return unsupported
+
+    def check(value):
+        if coerce is not None:
+            value = coerce(value)
+        if not isinstance(value, types):
+            raise Invalid()
+        if inner is not None:
+            return inner(value)
+        return value
+    return check
+
+
+def compile_fields(fields_schema):
+    ''' Compile a dict schema into a function that returns the coerced dict
+        param: fields_schema dictionary of field name and rules
+        return: function(doc) raising Invalid or the coercion error
+    '''
+    fields = [(name, compile_rule(rule)) for name, rule in fields_schema.iteritems()]
+    allowed = frozenset(fields_schema)
+    required = frozenset(name for name, rule in fields_schema.iteritems() if rule.get('required'))
+    all_required = allowed == required
+
+    def check(doc):
+        if all_required:
+            # a missing field raises KeyError below
+            if len(doc) != len(fields):
+                raise Invalid()
+            return dict((name, check_value(doc[name])) for name, check_value in fields)
+        if not allowed.issuperset(doc) or not required.issubset(doc):
+            raise Invalid()
+        return dict((name, check_value(doc[name])) for name, check_value in fields if name in doc)
+    return check
+
+
+def compile_schema(element_schema=SCHEMA):
+    ''' Compile the element schema, one check function per element type
+        return: function(element) returning the coerced element
+    '''
+    checks = dict((name, compile_rule(rule)) for name, rule in element_schema.iteritems())
+
+    def check(element):
+        if not isinstance(element, dict):
+            raise Invalid()
+        return dict((name, checks[name](value)) for name, value in element.iteritems())
+    return check
+
+
+class FastValidator(object):
+    ''' Drop in replacement of cerberus.Validator for validate_element'''
+
+    def __init__(self):
+        self.fallback = cerberus.Validator()
+        self.compiled = []
+        self.errors = {}
+        self.document = None
+
+    def checker(self, element_schema):
+        for compiled_schema, check in self.compiled:
+            if compiled_schema is element_schema:
+                return check
+        check = compile_schema(element_schema)
+        self.compiled.append((element_schema, check))
+        return check
+
+    def validate(self, document, element_schema):
+        ''' Validate document against element_schema, return True if valid
+            When the fast checks fail cerberus decides and fills errors
+        '''
+        try:
+            self.document = self.checker(element_schema)(document)
+            self.errors = {}
+            return True
+        except Exception:
+            result = self.fallback.validate(document, element_schema)
+            self.document = self.fallback.document
+            self.errors = self.fallback.errors
+            return result
+
+
+def benchmark(osm_file, limit=None):
+    ''' Shape the elements of osm_file and time cerberus against FastValidator
+        param: osm_file to shape
+        param: limit max number of elements to shape
+        return: dictionary with seconds and elements per second for each validator
+    '''
+    # imported here as dublin_openstreet imports this module
+    from dublin_openstreet import get_element, shape_element, validate_element
+
+    elements = []
+    for element in get_element(osm_file, tags=('node', 'way')):
+        elements.append(shape_element(element))
+        if limit and len(elements) >= limit:
+            break
+
+    result = {}
+    for name, validator in [('cerberus', cerberus.Validator()), ('fast', FastValidator())]:
+        start = time.time()
+        for el in elements:
+            validate_element(el, validator)
+        seconds = time.time() - start
+        result[name] = { 'seconds': seconds,
+                         'elements_per_sec': len(elements) / seconds if seconds else 0.0 }
+        print "{:<10} {:>8,d} elements {:>8.2f}s {:>12,.0f} elements/s".format(
+            name, len(elements), seconds, result[name]['elements_per_sec'])
+    print "speedup    {:.1f}x".format(result['cerberus']['seconds'] / result['fast']['seconds'])
+    return result
+
+
+if __name__ == '__main__':
+    # i.e python fast_validator.py sample.osm 100000
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else 'sample.osm',
+              int(sys.argv[2]) if len(sys.argv) > 2 else None)
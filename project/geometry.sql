@@ -0,0 +1,23 @@
+-- Geometry of every way, assembled once from ways_nodes and nodes by way_geometry.py
+-- so queries and exports read one row per way instead of joining its nodes.
+--   coords: little endian float64 lat, lon pairs of the nodes in position order
+--           (nodes missing from the extract are left out)
+--   points: number of pairs in coords
+--   min_lat, min_lon, max_lat, max_lon: bbox of the coords, NULL without points
+--   length_m: length of the line in meters
+--   closed: 1 if the first and last node of the way are the same node
+
+DROP TABLE IF EXISTS way_geometry;
+
+CREATE TABLE way_geometry (
+    id INTEGER PRIMARY KEY NOT NULL,
+    coords BLOB NOT NULL,
+    points INTEGER NOT NULL,
+    min_lat REAL,
+    min_lon REAL,
+    max_lat REAL,
+    max_lon REAL,
+    length_m REAL NOT NULL,
+    closed INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES ways(id)
+);
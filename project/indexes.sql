@@ -0,0 +1,6 @@
+CREATE INDEX nodes_tags_key_value ON nodes_tags(key, value);
+CREATE INDEX ways_tags_key_value ON ways_tags(key, value);
+CREATE INDEX ways_nodes_id_position ON ways_nodes(id, position);
+CREATE INDEX ways_nodes_node_id ON ways_nodes(node_id);
+CREATE INDEX nodes_tags_id ON nodes_tags(id);
+CREATE INDEX ways_tags_id ON ways_tags(id);
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Run several audits over an OSM file with a single parse.
+
+Each audit is a visitor with a visit(element) method called on the "end"
+event of the elements it is interested in (tags, None means every element),
+and a report() method returning its result. run_audit streams the file once,
+hands every element to the visitors that asked for it and clears the tree
+after each top level element, so memory stays flat.
+
+i.e
+    reports = run_audit('dublin.osm', default_visitors())
+    reports['street_types']
+'''
+import sys
+import pprint
+from collections import defaultdict
+
+import xml.etree.cElementTree as ET
+
+from tag_keys import KEYS
+from osm_input import open_osm
+from dublin_openstreet import audit_street_type, is_street_name
+
+TOP_LEVEL_TAGS = ('node', 'way', 'relation')
+
+
+class AuditVisitor(object):
+    ''' Base class of the audits run by run_audit'''
+    name = None
+    # tags of the elements to visit, None to visit every element
+    tags = None
+
+    def visit(self, element):
+        ''' Audit one element, called for every element of tags'''
+        pass
+
+    def report(self):
+        ''' return: result of the audit, stored under its name in the reports of run_audit'''
+        return {}
+
+
+class TagCounter(AuditVisitor):
+    ''' Number of elements of each tag, as lesson13/mapparser.count_tags'''
+    name = 'tag_counts'
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def visit(self, element):
+        self.counts[element.tag] += 1
+
+    def report(self):
+        return dict(self.counts)
+
+
+class KeyCategories(AuditVisitor):
+    ''' Category of the key of each <tag>, as lesson13/tags.process_map'''
+    name = 'key_categories'
+    tags = ('tag',)
+
+    def __init__(self, classifier=KEYS):
+        self.classifier = classifier
+        self.keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
+
+    def visit(self, element):
+        self.keys[self.classifier.classify(element.attrib['k']).category] += 1
+
+    def report(self):
+        return self.keys
+
+
+class UniqueUsers(AuditVisitor):
+    ''' Set of users that contributed, as lesson13/users.process_map'''
+    name = 'unique_users'
+    tags = TOP_LEVEL_TAGS
+
+    def __init__(self):
+        self.users = set()
+
+    def visit(self, element):
+        user = element.attrib.get('user')
+        if user:
+            self.users.add(user)
+
+    def report(self):
+        return self.users
+
+
+class StreetTypes(AuditVisitor):
+    ''' Unexpected street types of the addr:street tags, as dublin_openstreet.audit'''
+    name = 'street_types'
+    tags = ('node', 'way')
+
+    def __init__(self):
+        self.street_types = defaultdict(set)
+
+    def visit(self, element):
+        for tag in element.iter('tag'):
+            if is_street_name(tag):
+                audit_street_type(self.street_types, tag.attrib['v'])
+
+    def report(self):
+        return self.street_types
+
+
+def default_visitors():
+    return [TagCounter(), KeyCategories(), UniqueUsers(), StreetTypes()]
+
+
+def run_audit(osm_file, visitors):
+    ''' Parse osm_file once and hand each element to every visitor interested in its tag
+        param: osm_file path, compressed or not, or file object to audit
+        param: visitors list of AuditVisitor
+        return: dictionary with the report of each visitor by name
+    '''
+    if isinstance(osm_file, basestring):
+        with open_osm(osm_file) as f:
+            return run_audit(f, visitors)
+
+    visit_all = [visitor.visit for visitor in visitors if visitor.tags is None]
+    visit_by_tag = defaultdict(lambda: list(visit_all))
+    for visitor in visitors:
+        for tag in visitor.tags or ():
+            visit_by_tag[tag].append(visitor.visit)
+
+    context = ET.iterparse(osm_file, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end':
+            for visit in visit_by_tag[elem.tag]:
+                visit(elem)
+            if elem.tag in TOP_LEVEL_TAGS:
+                root.clear()
+
+    return dict((visitor.name, visitor.report()) for visitor in visitors)
+
+
+if __name__ == '__main__':
+    reports = run_audit(sys.argv[1] if len(sys.argv) > 1 else 'dublin.osm', default_visitors())
+    reports['unique_users'] = len(reports['unique_users'])
+    pprint.pprint(reports)
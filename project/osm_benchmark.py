@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmark of the stages of the OSM pipeline on a synthetic map.
+
+A deterministic synthetic OSM file is generated with synthetic_osm (it is
+kept in the work directory for the next runs with the same parameters) and
+every stage runs in its own process, so the peak RSS of each one is measured
+on its own:
+
+  - parse: get_element over every node and way
+  - shape: shape_element, timed around the calls only
+  - validate: validate_element of the shaped elements, timed around the calls only
+  - write_csv: the csv writer, timed around the calls only
+  - audit: dublin_openstreet.audit
+  - process_map: parse, shape, validate and write the csv(s), with --workers
+  - create_tables: DB.create_tables
+  - insert_records: DB.insert_records of the process_map csv(s)
+  - end_to_end: process_map and DB.bulk_load
+
+The seconds, elements per second and peak RSS of every stage are written to
+a JSON file, --compare prints the change against a previous one.
+
+i.e python osm_benchmark.py --nodes 200000 -o bench.json
+    python osm_benchmark.py --nodes 200000 -o bench2.json --compare bench.json
+    python osm_benchmark.py --stages parse,shape --keys highway=40,addr:street=20
+'''
+import os
+import json
+import time
+import Queue
+import hashlib
+import argparse
+import platform
+import resource
+import traceback
+import multiprocessing
+from collections import OrderedDict
+
+import synthetic_osm
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCHEMA_FILE = os.path.join(PROJECT_DIR, 'schema.sql')
+INSERT_FILE = os.path.join(PROJECT_DIR, 'insert_records.sqlite3')
+INDEXES_FILE = os.path.join(PROJECT_DIR, 'indexes.sql')
+SUMMARIES_FILE = os.path.join(PROJECT_DIR, 'summaries.sql')
+SPATIAL_FILE = os.path.join(PROJECT_DIR, 'spatial.sql')
+GEOMETRY_FILE = os.path.join(PROJECT_DIR, 'geometry.sql')
+
+WORK_DIR = 'benchmark'
+RESULTS_FILE = 'benchmark.json'
+DB_NAME = 'benchmark'
+NODES = 100000
+# seconds to wait for the result of one stage
+STAGE_TIMEOUT = 3600
+STAGES = ['parse', 'shape', 'validate', 'write_csv', 'audit',
+          'process_map', 'create_tables', 'insert_records', 'end_to_end']
+
+
+def parse_keys(value, keys=synthetic_osm.KEYS):
+    ''' Change the weights of the synthetic keys i.e highway=40,addr:street=20
+        A key that is not in keys is added with the value "yes"
+        return: list of (key, weight, values) for synthetic_osm.write_osm
+    '''
+    weights = OrderedDict((key, (weight, values)) for key, weight, values in keys)
+    for pair in value.split(','):
+        key, weight = pair.rsplit('=', 1)
+        key = key.strip()
+        weights[key] = (int(weight), weights.get(key, (0, ['yes']))[1])
+    return [(key, weight, values) for key, (weight, values) in weights.iteritems() if weight > 0]
+
+
+def synthetic_file(params, work_dir=WORK_DIR):
+    ''' Generate the synthetic file of params once
+        return: path of the file
+    '''
+    digest = hashlib.md5(json.dumps(params, sort_keys=True)).hexdigest()[:8]
+    path = os.path.join(work_dir, "synthetic_{}_{}.osm".format(params['nodes'], digest))
+    if not os.path.exists(path):
+        print "Generating {} ...".format(path)
+        synthetic_osm.generate(path, params['nodes'], params['ways'],
+                               tags_per_element=params['tags_per_element'],
+                               nodes_per_way=params['nodes_per_way'],
+                               keys=params['keys'], seed=params['seed'])
+    return path
+
+
+def elements_of(osm_file):
+    from dublin_openstreet import get_element
+    return get_element(osm_file, tags=('node', 'way'))
+
+
+def stage_parse(osm_file, options):
+    elements = 0
+    for _ in elements_of(osm_file):
+        elements += 1
+    return elements, None
+
+
+def stage_shape(osm_file, options):
+    from dublin_openstreet import shape_element
+    elements, seconds = 0, 0.0
+    for element in elements_of(osm_file):
+        start = time.time()
+        shape_element(element)
+        seconds += time.time() - start
+        elements += 1
+    return elements, seconds
+
+
+def stage_validate(osm_file, options):
+    from dublin_openstreet import shape_element, validate_element, new_validator
+    validator = new_validator()
+    elements, seconds = 0, 0.0
+    for element in elements_of(osm_file):
+        el = shape_element(element)
+        start = time.time()
+        validate_element(el, validator)
+        seconds += time.time() - start
+        elements += 1
+    return elements, seconds
+
+
+def stage_write_csv(osm_file, options):
+    from dublin_openstreet import shape_element, CSVWriter
+    elements, seconds = 0, 0.0
+    writer = CSVWriter()
+    for element in elements_of(osm_file):
+        el = shape_element(element)
+        start = time.time()
+        if element.tag == 'node':
+            writer.write_node(el)
+        else:
+            writer.write_way(el)
+        seconds += time.time() - start
+        elements += 1
+    start = time.time()
+    writer.close()
+    return elements, seconds + time.time() - start
+
+
+def stage_audit(osm_file, options):
+    from dublin_openstreet import audit
+    audit(osm_file)
+    return options['elements'], None
+
+
+def stage_process_map(osm_file, options):
+    from dublin_openstreet import process_map
+    process_map(osm_file, validate=True, workers=options['workers'])
+    return options['elements'], None
+
+
+def stage_create_tables(osm_file, options):
+    from dublin_db import DB
+    db = DB(DB_NAME)
+    db.create_tables(SCHEMA_FILE)
+    db.close_connection()
+    return options['elements'], None
+
+
+def stage_insert_records(osm_file, options):
+    ''' Load the csv(s) left by the process_map stage into empty tables'''
+    from dublin_db import DB
+    db = DB(DB_NAME)
+    db.create_tables(SCHEMA_FILE)
+    db.close_connection()
+    start = time.time()
+    db.insert_records(INSERT_FILE)
+    return options['elements'], time.time() - start
+
+
+def stage_end_to_end(osm_file, options):
+    from dublin_openstreet import process_map
+    from dublin_db import DB
+    process_map(osm_file, validate=True, workers=options['workers'])
+    db = DB(DB_NAME)
+    db.bulk_load(lambda: db.insert_records(INSERT_FILE), SCHEMA_FILE, INDEXES_FILE, SUMMARIES_FILE, SPATIAL_FILE,
+                 GEOMETRY_FILE)
+    db.close_connection()
+    return options['elements'], None
+
+
+def peak_rss_mb():
+    ''' Peak RSS of this process and of its finished children, in MB (ru_maxrss is in KB on linux)'''
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.0
+
+
+def run_stage(name, osm_file, options, work_dir, queue):
+    ''' Run one stage in work_dir and put its result in queue, or the traceback if it fails'''
+    try:
+        osm_file = os.path.abspath(osm_file)
+        os.chdir(work_dir)
+        stage = globals()['stage_' + name]
+        start = time.time()
+        elements, seconds = stage(osm_file, options)
+        wall_seconds = time.time() - start
+    except Exception:
+        queue.put((None, traceback.format_exc()))
+        raise
+    queue.put(({ 'seconds': seconds if seconds is not None else wall_seconds,
+                 'wall_seconds': wall_seconds,
+                 'elements': elements,
+                 'peak_rss_mb': peak_rss_mb() }, None))
+
+
+def measure(name, osm_file, options, work_dir=WORK_DIR, timeout=STAGE_TIMEOUT):
+    ''' return: result of the stage, run in a new process'''
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_stage, args=(name, osm_file, options, work_dir, queue))
+    process.start()
+    # read before joining, the child can not exit until its result is flushed to the queue
+    try:
+        result, error = queue.get(timeout=timeout)
+    except Queue.Empty:
+        result, error = None, "no result after {}s".format(timeout)
+    if error is not None and process.is_alive():
+        process.terminate()
+    process.join()
+    if error is not None:
+        raise RuntimeError("Stage {} failed: {}".format(name, error))
+    if process.exitcode != 0:
+        raise RuntimeError("Stage {} failed with exit code {}".format(name, process.exitcode))
+    result['elements_per_second'] = result['elements'] / result['seconds'] if result['seconds'] else 0.0
+    return result
+
+
+def run(params, stages=STAGES, workers=1, work_dir=WORK_DIR):
+    ''' Generate the synthetic file and measure the stages
+        return: dictionary with the parameters, environment and result of every stage
+    '''
+    # as it is stored in the JSON file, so runs compare equal
+    params = json.loads(json.dumps(params))
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    osm_file = synthetic_file(params, work_dir)
+    options = { 'elements': params['nodes'] + params['ways'], 'workers': workers }
+    print "File: {} {:.1f}MB, {:,d} elements".format(osm_file, os.path.getsize(osm_file) / float(1 << 20),
+                                                     options['elements'])
+    results = OrderedDict()
+    for name in stages:
+        results[name] = measure(name, osm_file, options, work_dir)
+        report_stage(name, results[name])
+    return { 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+             'python': platform.python_version(),
+             'platform': platform.platform(),
+             'file': os.path.basename(osm_file),
+             'size_mb': os.path.getsize(osm_file) / float(1 << 20),
+             'params': params,
+             'workers': workers,
+             'stages': results }
+
+
+def report_stage(name, result):
+    print "{:<15} {:>9.2f}s {:>12,.0f} elements/s {:>9.1f}MB peak RSS".format(
+        name, result['seconds'], result['elements_per_second'], result['peak_rss_mb'])
+
+
+def compare(current, previous):
+    ''' Print the change of seconds and peak RSS of every stage against a previous run'''
+    if current['params'] != previous['params']:
+        print "Warning: the runs used different synthetic files"
+    print "{:<15} {:>10} {:>10} {:>8} {:>10}".format('stage', 'previous', 'current', 'change', 'RSS change')
+    for name, result in current['stages'].iteritems():
+        before = previous['stages'].get(name)
+        if before is None:
+            continue
+        change = (result['seconds'] - before['seconds']) / before['seconds'] if before['seconds'] else 0.0
+        print "{:<15} {:>9.2f}s {:>9.2f}s {:>+8.1%} {:>+8.1f}MB".format(
+            name, before['seconds'], result['seconds'], change, result['peak_rss_mb'] - before['peak_rss_mb'])
+
+
+def main():
+    ''' Cli to benchmark the pipeline stages'''
+    parser = argparse.ArgumentParser(description='Benchmark the OSM pipeline stages on a synthetic map',
+                                     prog='osm_benchmark')
+    parser.add_argument('--nodes', type=int, default=NODES, help='nodes of the synthetic map')
+    parser.add_argument('--ways', type=int, help='ways of the synthetic map, nodes / 10 by default')
+    parser.add_argument('--tags', type=int, default=4, help='max tags of each node and way')
+    parser.add_argument('--nodes-per-way', type=int, default=8, help='max nodes of each way')
+    parser.add_argument('--keys', type=parse_keys, default=synthetic_osm.KEYS,
+                        help='weights of the tag keys i.e highway=40,addr:street=20')
+    parser.add_argument('--seed', type=int, default=synthetic_osm.SEED, help='seed of the synthetic map')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated stages to run')
+    parser.add_argument('--workers', type=int, default=1, help='processes of process_map')
+    parser.add_argument('--work-dir', default=WORK_DIR, help='directory for the map, csv(s) and db')
+    parser.add_argument('-o', '--output', default=RESULTS_FILE, help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(',')]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error("unknown stages: {}".format(', '.join(unknown)))
+
+    params = { 'nodes': args.nodes,
+               'ways': args.ways if args.ways is not None else args.nodes // 10,
+               'tags_per_element': args.tags,
+               'nodes_per_way': args.nodes_per_way,
+               'keys': args.keys,
+               'seed': args.seed }
+    results = run(params, stages, args.workers, args.work_dir)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print "Results written to {}".format(args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Apply OSM change files (osmChange .osc) to the db, without a full rebuild.
+
+The create and modify blocks are cleaned with the same shape_element used
+for the full import and upserted into nodes, ways and their tags/way nodes
+tables. The delete blocks remove the element and its rows. The whole file is
+applied in one transaction together with its replication sequence number,
+stored in the metadata table, so a file is either applied completely or not
+at all, and a file whose sequence is not newer than the stored one is skipped.
+The addr:street values are rewritten with the table of street fixes the db
+was loaded with, kept in the metadata table too, as a full load would.
+The summary tables of summaries.sql and nodes_rtree of spatial.sql are kept
+up to date by their triggers, the way_geometry rows of the ways changed (or
+whose nodes changed) are rebuilt once per way before the commit, together
+with their ways_rtree envelopes. They are all built first on a db loaded
+before they existed.
+
+i.e python osm_changes.py 002.osc.gz --state 002.state.txt
+    python osm_changes.py 002.osc --sequence 2
+'''
+import os
+import argparse
+
+import xml.etree.cElementTree as ET
+
+from dublin_db import DB, SUMMARY_TABLES, SPATIAL_TABLES
+from way_geometry import update_way_geometry, GEOMETRY_TABLE
+from osm_input import open_osm
+from dublin_openstreet import shape_element, to_row, new_validator, validate_element, stored_street_fixes, \
+    DB_NAME, NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_TAGS_FIELDS, WAY_NODES_FIELDS
+from street_names import STREET_FIXES
+
+ACTIONS = ('create', 'modify', 'delete')
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+SUMMARIES_FILE = os.path.join(PROJECT_DIR, 'summaries.sql')
+SPATIAL_FILE = os.path.join(PROJECT_DIR, 'spatial.sql')
+GEOMETRY_FILE = os.path.join(PROJECT_DIR, 'geometry.sql')
+SEQUENCE_KEY = 'replication_sequence'
+
+# child tables of each element, rows are deleted by id before an upsert or on a delete
+CHILD_TABLES = { 'node': ['nodes_tags'],
+                 'way': ['ways_tags', 'ways_nodes'] }
+ELEMENT_TABLES = { 'node': 'nodes', 'way': 'ways' }
+
+
+def read_state(state_file):
+    ''' return: sequenceNumber of a replication state.txt file'''
+    with open(state_file) as f:
+        for line in f:
+            if line.startswith('sequenceNumber='):
+                return int(line.split('=', 1)[1])
+    raise ValueError("No sequenceNumber in {}".format(state_file))
+
+
+def iter_changes(osc_file):
+    ''' Yield (action, element) of each node, way and relation of the change file'''
+    with open_osm(osc_file) as f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        action = None
+        for event, elem in context:
+            if event == 'start':
+                if elem.tag in ACTIONS:
+                    action = elem
+            elif elem.tag in ('node', 'way', 'relation') and action is not None:
+                yield action.tag, elem
+                action.clear()
+            elif elem.tag in ACTIONS:
+                action = None
+                root.clear()
+
+
+class ChangeApplier:
+    ''' Statements to upsert and delete the elements on the db connection'''
+
+    def __init__(self, db):
+        self.db = db
+        self.connection = db.connection
+        self.counts = dict(("{}_{}".format(action, tag), 0) for action in ACTIONS for tag in ELEMENT_TABLES)
+        # ways whose way_geometry row must be rebuilt
+        self.changed_ways = set()
+
+    def delete(self, tag, element_id):
+        self.changed(tag, element_id)
+        for table in CHILD_TABLES[tag] + [ELEMENT_TABLES[tag]]:
+            self.connection.execute("DELETE FROM {} WHERE id = ?".format(table), (element_id,))
+
+    def changed(self, tag, element_id):
+        ''' Track the way, or the ways of the node, for update_way_geometry'''
+        if tag == 'way':
+            self.changed_ways.add(int(element_id))
+        else:
+            self.changed_ways.update(way_id for way_id, in self.connection.execute(
+                "SELECT DISTINCT id FROM ways_nodes WHERE node_id = ?", (element_id,)))
+
+    def insert(self, table, rows):
+        self.connection.executemany(self.db.insert_statement(table), rows)
+
+    def upsert(self, el):
+        ''' Replace the element and its child rows with the shaped element el'''
+        if 'node' in el:
+            self.delete('node', el['node']['id'])
+            self.insert('nodes', [to_row(el['node'], NODE_FIELDS)])
+            self.insert('nodes_tags', [to_row(tag, NODE_TAGS_FIELDS) for tag in el['node_tags']])
+        else:
+            self.delete('way', el['way']['id'])
+            self.insert('ways', [to_row(el['way'], WAY_FIELDS)])
+            self.insert('ways_nodes', [to_row(nd, WAY_NODES_FIELDS) for nd in el['way_nodes']])
+            self.insert('ways_tags', [to_row(tag, WAY_TAGS_FIELDS) for tag in el['way_tags']])
+
+    def apply(self, action, element, validator=None):
+        if element.tag not in ELEMENT_TABLES:
+            return
+        if action == 'delete':
+            self.delete(element.tag, element.attrib['id'])
+        else:
+            el = shape_element(element)
+            if validator is not None:
+                validate_element(el, validator)
+            self.upsert(el)
+        self.counts["{}_{}".format(action, element.tag)] += 1
+
+
+def apply_changes(osc_file, db_name=DB_NAME, sequence=None, validate=False, summaries_file=SUMMARIES_FILE,
+                  spatial_file=SPATIAL_FILE, geometry_file=GEOMETRY_FILE, street_fixes=None):
+    ''' Apply the change file to the db in one transaction
+        param: osc_file path to the .osc file, it can be compressed
+        param: sequence replication sequence number of the file, stored in the metadata table
+        param: validate the shaped elements against the schema
+        param: summaries_file to build the summary tables from if the db does not have them
+        param: spatial_file to build the rtree indexes from if the db does not have them
+        param: geometry_file to build the way_geometry table from if the db does not have it
+        param: street_fixes dictionary of addr:street values and their fix, the table stored
+               in the db by the load if None
+        return: dictionary with the number of elements created, modified and deleted, None if skipped
+    '''
+    db = DB(db_name)
+    db.connect_to_db()
+    try:
+        db.create_metadata_table()
+        if not db.has_tables(SUMMARY_TABLES):
+            db.create_summaries(summaries_file)
+        # ways_rtree is filled from way_geometry
+        if not db.has_tables([GEOMETRY_TABLE]):
+            db.create_way_geometry(geometry_file)
+        if not db.has_tables(SPATIAL_TABLES):
+            db.create_spatial_index(spatial_file)
+        current = db.get_metadata(SEQUENCE_KEY)
+        if sequence is not None and current is not None and int(sequence) <= int(current):
+            print "Skipping {}: sequence {} already applied (db at {})".format(osc_file, sequence, current)
+            return None
+
+        STREET_FIXES.load(stored_street_fixes(db) if street_fixes is None else street_fixes)
+        applier = ChangeApplier(db)
+        validator = new_validator() if validate else None
+        try:
+            for action, element in iter_changes(osc_file):
+                applier.apply(action, element, validator)
+            update_way_geometry(db.connection, applier.changed_ways)
+            if sequence is not None:
+                db.set_metadata(SEQUENCE_KEY, sequence)
+            db.connection.commit()
+        except:
+            db.connection.rollback()
+            raise
+    finally:
+        db.close_connection()
+
+    print "Applied {} to db:{}.db sequence:{}".format(osc_file, db_name, sequence)
+    for name, count in sorted(applier.counts.iteritems()):
+        print "{:<16} {:>10,d}".format(name, count)
+    return applier.counts
+
+
+def main():
+    ''' Cli to apply a change file to the db'''
+    parser = argparse.ArgumentParser(description='Apply an osmChange file to the db', prog='osm_changes')
+    parser.add_argument('osc_file', help='.osc file to apply, it can be compressed')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--sequence', type=int, help='replication sequence number of the file')
+    group.add_argument('--state', help='replication state.txt file with the sequence number of the file')
+    parser.add_argument('--db', default=DB_NAME, help='db name, without the .db extension')
+    parser.add_argument('--validate', action='store_true', help='validate the elements against the schema')
+    args = parser.parse_args()
+
+    sequence = read_state(args.state) if args.state else args.sequence
+    apply_changes(args.osc_file, args.db, sequence, args.validate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Typed columnar output of the shaped map, an alternative to the csv(s).
+
+Each table is written to its own directory as row groups of ROW_GROUP_SIZE
+rows, so only one row group per table is kept in memory:
+  - ids, uid, changeset, version of the nodes and position are int64
+  - lat and lon are float64
+  - key, type and user are dictionary encoded: int32 codes and the distinct
+    values of the row group
+  - other text (value, timestamp, version of the ways) is utf-8 data with
+    int64 offsets, as Arrow stores strings
+
+With pyarrow installed the tables are written as Parquet, one file per shard
+with one row group per ROW_GROUP_SIZE rows. Without it every row group is a
+NumPy .npz chunk, read back with read_row_groups:
+
+    part-<shard>-<row group>.npz  or  part-<shard>-00000.parquet
+
+Missing numbers are stored as -1 (integers) and NaN (floats).
+'''
+import os
+import re
+import shutil
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+ROW_GROUP_SIZE = 100000
+FORMAT = 'parquet' if pq is not None else 'npz'
+PART_RE = re.compile(r'^part-(\d+)-(\d+)\.(npz|parquet)$')
+
+INT, FLOAT, STRING, DICTIONARY = 'int64', 'float64', 'string', 'dictionary'
+
+# Columns of each table in the order of schema.sql
+COLUMNS = {
+    'nodes': [('id', INT), ('lat', FLOAT), ('lon', FLOAT), ('user', DICTIONARY), ('uid', INT),
+              ('version', INT), ('changeset', INT), ('timestamp', STRING)],
+    'nodes_tags': [('id', INT), ('key', DICTIONARY), ('value', STRING), ('type', DICTIONARY)],
+    'ways': [('id', INT), ('user', DICTIONARY), ('uid', INT), ('version', STRING),
+             ('changeset', INT), ('timestamp', STRING)],
+    'ways_tags': [('id', INT), ('key', DICTIONARY), ('value', STRING), ('type', DICTIONARY)],
+    'ways_nodes': [('id', INT), ('node_id', INT), ('position', INT)],
+}
+TABLES = ['nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags']
+PATHS = ["{}.columns".format(table) for table in TABLES]
+
+
+def to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def string_array(values):
+    ''' return: utf-8 data as uint8 array, int64 offsets of each value (len(values) + 1)'''
+    data = [to_bytes(value) for value in values]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in data], out=offsets[1:])
+    return np.frombuffer(''.join(data), dtype=np.uint8), offsets
+
+
+def strings_of(data, offsets):
+    ''' Decode a string_array back to a list of unicode'''
+    raw = data.tostring()
+    return [raw[offsets[i]:offsets[i + 1]].decode('utf-8') for i in xrange(len(offsets) - 1)]
+
+
+def dictionary_array(values):
+    ''' return: int32 codes of each value, list of the distinct values in code order'''
+    codes = {}
+    encoded = np.fromiter((codes.setdefault(value, len(codes)) for value in values),
+                          dtype=np.int32, count=len(values))
+    dictionary = [None] * len(codes)
+    for value, code in codes.iteritems():
+        dictionary[code] = value
+    return encoded, dictionary
+
+
+def number_array(values, dtype):
+    missing = -1 if dtype == INT else np.nan
+    return np.array([missing if value in ('', None) else value for value in values], dtype=dtype)
+
+
+def encode_columns(table, columns):
+    ''' Arrays of one row group of the table, named as stored in the .npz chunks
+        param: columns dictionary of column name and list of values
+    '''
+    arrays = {}
+    for name, kind in COLUMNS[table]:
+        values = columns[name]
+        if kind == STRING:
+            arrays[name + '.data'], arrays[name + '.offsets'] = string_array(values)
+        elif kind == DICTIONARY:
+            codes, dictionary = dictionary_array(values)
+            arrays[name + '.codes'] = codes
+            arrays[name + '.dictionary.data'], arrays[name + '.dictionary.offsets'] = string_array(dictionary)
+        else:
+            arrays[name] = number_array(values, kind)
+    return arrays
+
+
+def arrow_table(table, columns):
+    ''' pyarrow Table of one row group of the table'''
+    arrays = []
+    for name, kind in COLUMNS[table]:
+        values = columns[name]
+        if kind in (STRING, DICTIONARY):
+            array = pa.array([to_bytes(value).decode('utf-8') for value in values], type=pa.string())
+            if kind == DICTIONARY:
+                array = array.dictionary_encode()
+        else:
+            array = pa.array(number_array(values, kind))
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, [name for name, _ in COLUMNS[table]])
+
+
+class TableWriter(object):
+    ''' Buffer the rows of one table and write them a row group at a time'''
+
+    def __init__(self, table, path, fmt=FORMAT, row_group_size=ROW_GROUP_SIZE):
+        self.table = table
+        self.path = path
+        self.format = fmt
+        self.row_group_size = row_group_size
+        self.names = [name for name, _ in COLUMNS[table]]
+        self.columns = dict((name, []) for name in self.names)
+        self.rows = 0
+        self.row_groups = 0
+        self.parquet = None
+        clear_parts(path)
+
+    def write(self, record):
+        self.write_row([record.get(name, '') for name in self.names])
+
+    def writerows(self, records):
+        for record in records:
+            self.write(record)
+
+    def write_row(self, row):
+        ''' param: row values in COLUMNS order'''
+        for name, value in zip(self.names, row):
+            self.columns[name].append(value)
+        self.rows += 1
+        if self.rows >= self.row_group_size:
+            self.flush()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.format == 'parquet':
+            if self.parquet is None:
+                self.parquet = pq.ParquetWriter(os.path.join(self.path, part_name(0, 0, 'parquet')),
+                                                arrow_table(self.table, self.columns).schema)
+            self.parquet.write_table(arrow_table(self.table, self.columns))
+        else:
+            np.savez(os.path.join(self.path, part_name(0, self.row_groups, 'npz')),
+                     **encode_columns(self.table, self.columns))
+        self.row_groups += 1
+        self.columns = dict((name, []) for name in self.names)
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        if self.parquet is not None:
+            self.parquet.close()
+
+
+def part_name(shard, row_group, ext):
+    return "part-{:05d}-{:05d}.{}".format(shard, row_group, ext)
+
+
+def parts_of(path):
+    ''' return: sorted part files of a table directory'''
+    if not os.path.isdir(path):
+        return []
+    return sorted(name for name in os.listdir(path) if PART_RE.match(name))
+
+
+def clear_parts(path):
+    ''' Create the table directory, removing the parts of a previous run'''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name in parts_of(path):
+        os.remove(os.path.join(path, name))
+
+
+class ColumnarWriter(object):
+    ''' process_map output backend writing every table to its own directory of row groups'''
+
+    def __init__(self, paths=PATHS, fmt=FORMAT, row_group_size=ROW_GROUP_SIZE):
+        self.writers = [TableWriter(table, path, fmt, row_group_size) for table, path in zip(TABLES, paths)]
+        self.nodes, self.nodes_tags, self.ways, self.ways_nodes, self.ways_tags = self.writers
+
+    def write_node(self, el):
+        self.nodes.write(el['node'])
+        self.nodes_tags.writerows(el['node_tags'])
+
+    def write_way(self, el):
+        self.ways.write(el['way'])
+        self.ways_nodes.writerows(el['way_nodes'])
+        self.ways_tags.writerows(el['way_tags'])
+
+    def write_node_rows(self, node, tags):
+        self.nodes.write_row(node)
+        self.nodes_tags.write_rows(tags)
+
+    def write_way_rows(self, way, way_nodes, tags):
+        self.ways.write_row(way)
+        self.ways_nodes.write_rows(way_nodes)
+        self.ways_tags.write_rows(tags)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def merge(shard_paths, paths=PATHS):
+        ''' Move the parts of every shard into the table directories, numbered in shard order'''
+        for idx, path in enumerate(paths):
+            clear_parts(path)
+            for shard, shard_path in enumerate(shard[idx] for shard in shard_paths):
+                for name in parts_of(shard_path):
+                    _, row_group, ext = PART_RE.match(name).groups()
+                    shutil.move(os.path.join(shard_path, name),
+                                os.path.join(path, part_name(shard, int(row_group), ext)))
+
+
+def read_row_groups(path, columns=None):
+    ''' Yield the row groups of a .npz table directory as dictionaries of arrays
+        Dictionary encoded columns are returned as (codes, dictionary) and string
+        columns as lists of unicode. Parquet directories can be read with
+        pyarrow.parquet.read_table(path) instead.
+        param: columns names of the columns to read, all if None
+    '''
+    for name in parts_of(path):
+        if not name.endswith('.npz'):
+            raise ValueError("{} is not a .npz part, read it with pyarrow.parquet".format(name))
+        chunk = np.load(os.path.join(path, name))
+        table = {}
+        for arrays in chunk.files:
+            column = arrays.split('.', 1)[0]
+            if column in table or (columns is not None and column not in columns):
+                continue
+            if column + '.codes' in chunk.files:
+                table[column] = (chunk[column + '.codes'],
+                                 strings_of(chunk[column + '.dictionary.data'], chunk[column + '.dictionary.offsets']))
+            elif column + '.offsets' in chunk.files:
+                table[column] = strings_of(chunk[column + '.data'], chunk[column + '.offsets'])
+            else:
+                table[column] = chunk[column]
+        yield table
+
+
+def most_used_keys(path, min_count=1000):
+    ''' Count of each tag key of a nodes_tags or ways_tags directory, as the
+        nodes_most_used_keys query but scanning only the key codes
+        return: list of (count, key) sorted by count desc
+    '''
+    counts = {}
+    for table in read_row_groups(path, columns=['key']):
+        codes, dictionary = table['key']
+        for code, count in enumerate(np.bincount(codes, minlength=len(dictionary))):
+            counts[dictionary[code]] = counts.get(dictionary[code], 0) + int(count)
+    return sorted(((count, key) for key, count in counts.iteritems() if count >= min_count), reverse=True)
+
+
+if __name__ == '__main__':
+    import sys
+    for count, key in most_used_keys(sys.argv[1] if len(sys.argv) > 1 else PATHS[1]):
+        print "{:>10,d} {}".format(count, key)
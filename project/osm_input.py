@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Open OSM files for reading, compressed or not.
+
+Files ending in .bz2, .gz or .xz are decompressed while they are read, they
+are never written to disk decompressed. When a command line decompressor is
+installed it runs in its own process feeding a pipe, so decompression
+overlaps the parsing. lbzip2 and pbzip2 also decompress the streams of a
+multi-stream .bz2 (i.e the planet and geofabrik extracts) in parallel threads.
+Without any of them the file is decompressed in this process, .xz files then
+need the lzma module (backports.lzma in python 2, not in requirements.txt).
+
+i.e
+    with open_osm('dublin.osm.bz2') as osm_file:
+        for event, elem in ET.iterparse(osm_file): ...
+'''
+import bz2
+import gzip
+import subprocess
+from distutils.spawn import find_executable
+
+COMPRESSIONS = { '.bz2': 'bz2',
+                 '.gz': 'gz',
+                 '.xz': 'xz' }
+
+# Command line decompressors of each compression, the first one installed is used
+DECOMPRESSORS = { 'bz2': [['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']],
+                  'gz': [['pigz', '-dc'], ['gzip', '-dc']],
+                  'xz': [['xz', '-dc']] }
+
+CHUNK_SIZE = 1 << 20
+
+
+def compression_of(path):
+    ''' return: compression of the file by its extension, None if it is not compressed'''
+    for extension, compression in COMPRESSIONS.iteritems():
+        if path.endswith(extension):
+            return compression
+    return None
+
+
+def is_compressed(path):
+    return isinstance(path, basestring) and compression_of(path) is not None
+
+
+def find_decompressor(compression):
+    ''' return: command line of the first decompressor installed, None if there is none'''
+    for command in DECOMPRESSORS[compression]:
+        if find_executable(command[0]):
+            return command
+    return None
+
+
+def import_lzma(reason):
+    ''' return: lzma module, backports.lzma in python 2
+        param: reason the module is needed, for the error when it is not installed
+    '''
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise ImportError("{} needs the backports.lzma package (pip install backports.lzma)".format(reason))
+    return lzma
+
+
+def open_osm(path, use_processes=True):
+    ''' Open the OSM file for reading, decompressing it as it is read
+        param: path to the .osm, .osm.bz2, .osm.gz or .osm.xz file
+        param: use_processes to decompress in a separate process when a decompressor is installed
+        return: file-like object with read and close
+    '''
+    compression = compression_of(path)
+    if compression is None:
+        return open(path, 'rb')
+
+    command = find_decompressor(compression) if use_processes else None
+    if command is not None:
+        return PipeReader(command + [path])
+    if compression == 'bz2':
+        return MultiStreamBZ2Reader(path)
+    if compression == 'gz':
+        return gzip.open(path, 'rb')
+    lzma = import_lzma("Reading {} without the xz command line tool".format(path))
+    return lzma.open(path, 'rb')
+
+
+class PipeReader(object):
+    ''' Read the standard output of a decompressor process'''
+
+    def __init__(self, command):
+        self.command = command
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=CHUNK_SIZE)
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if not data and self.process.wait() != 0:
+            raise IOError("{} failed with exit code {}".format(' '.join(self.command), self.process.returncode))
+        return data
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MultiStreamBZ2Reader(object):
+    ''' In process bz2 reader, bz2.BZ2File in python 2 stops at the end of the first stream'''
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.decompressor = bz2.BZ2Decompressor()
+        self.buffer = ''
+
+    def decompress(self, data):
+        chunks = []
+        while data:
+            try:
+                chunks.append(self.decompressor.decompress(data))
+            except EOFError:
+                # the previous stream ended right at the end of the last chunk
+                self.decompressor = bz2.BZ2Decompressor()
+                continue
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = bz2.BZ2Decompressor()
+        return ''.join(chunks)
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            data = self.file.read(CHUNK_SIZE)
+            if not data:
+                break
+            chunk = self.decompress(data)
+            chunks.append(chunk)
+            length += len(chunk)
+        data = ''.join(chunks)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Reader of the OSM PBF format (.osm.pbf) feeding shape_element.
+
+The file is a sequence of blobs, each one a zlib compressed PrimitiveBlock
+protobuf message. The blobs are read in this process and decoded in a
+process pool, keeping at most MAX_IN_FLIGHT blobs per worker in the pool so
+memory stays bounded. The protobuf wire format is decoded here, no protobuf
+library is needed.
+
+Nodes and ways are yielded as PBFElement objects with the tag, attrib and
+iter('tag') / iter('nd') that shape_element reads from the XML elements, so
+process_map and load_map work unchanged. Relations are skipped.
+
+Dense nodes, most of the data, are decoded with numpy a whole block at a
+time (varints, zigzag and delta coding) when numpy is installed.
+
+https://wiki.openstreetmap.org/wiki/PBF_Format
+'''
+import time
+import zlib
+import struct
+import multiprocessing
+from collections import deque
+
+from osm_input import import_lzma
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+WORKERS = multiprocessing.cpu_count()
+MAX_IN_FLIGHT = 4
+
+# protobuf wire types
+VARINT, FIXED64, LENGTH_DELIMITED, FIXED32 = 0, 1, 2, 5
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+COORDINATE_FORMAT = '%.7f'
+
+
+# ================================================== #
+#               Protobuf decoding                    #
+# ================================================== #
+def read_varint(data, pos):
+    ''' return: value of the varint at data[pos], position after it'''
+    value = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def iter_fields(data):
+    ''' Yield (field number, value) of each field of a message
+        varints are returned as unsigned ints, length delimited fields as str
+    '''
+    pos, end = 0, len(data)
+    while pos < end:
+        key, pos = read_varint(data, pos)
+        wire_type = key & 0x7
+        if wire_type == VARINT:
+            value, pos = read_varint(data, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            size, pos = read_varint(data, pos)
+            value = data[pos:pos + size]
+            pos += size
+        elif wire_type == FIXED64:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == FIXED32:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}".format(wire_type))
+        yield key >> 3, value
+
+
+def signed(value):
+    ''' int64 stored as an unsigned varint'''
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def zigzag(value):
+    ''' sint64 stored with zigzag encoding'''
+    return (value >> 1) ^ -(value & 1)
+
+
+def packed_varints(data):
+    ''' return: list of the unsigned varints packed in data'''
+    values = []
+    value = shift = 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            values.append(value)
+            value = shift = 0
+        else:
+            shift += 7
+    return values
+
+
+def packed_sint(data, delta=False):
+    ''' return: list of the zigzag encoded varints packed in data, delta decoded if delta'''
+    values = [zigzag(value) for value in packed_varints(data)]
+    if delta:
+        total = 0
+        for idx, value in enumerate(values):
+            total += value
+            values[idx] = total
+    return values
+
+
+def np_packed_varints(data):
+    ''' Vectorised packed_varints, return: numpy uint64 array'''
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if not len(raw):
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(raw < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # position of each byte inside its varint
+    shifts = (np.arange(len(raw)) - np.repeat(starts, ends - starts + 1)) * 7
+    parts = (raw & 0x7f).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(parts, starts)
+
+
+def np_packed_sint(data, delta=False):
+    ''' Vectorised packed_sint, return: numpy int64 array'''
+    values = np_packed_varints(data)
+    values = (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+    if delta:
+        return np.cumsum(values)
+    return values
+
+
+# ================================================== #
+#               OSM blocks decoding                  #
+# ================================================== #
+class Block(object):
+    ''' Settings of a PrimitiveBlock to turn the raw values into attributes'''
+
+    def __init__(self):
+        self.strings = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+
+    def lat(self, value):
+        return COORDINATE_FORMAT % (1e-9 * (self.lat_offset + self.granularity * value))
+
+    def lon(self, value):
+        return COORDINATE_FORMAT % (1e-9 * (self.lon_offset + self.granularity * value))
+
+    def timestamp(self, value):
+        return time.strftime(TIMESTAMP_FORMAT, time.gmtime(value * self.date_granularity // 1000))
+
+    def info_attrib(self, version, timestamp, changeset, uid, user_sid):
+        return { 'version': str(version),
+                 'timestamp': self.timestamp(timestamp),
+                 'changeset': str(changeset),
+                 'uid': str(uid),
+                 'user': self.strings[user_sid] }
+
+    def tags(self, keys, vals):
+        strings = self.strings
+        return [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+
+
+def decode_string(value):
+    ''' Strings as the XML parser returns them, str if ascii and unicode otherwise'''
+    try:
+        value.decode('ascii')
+        return value
+    except UnicodeDecodeError:
+        return value.decode('utf-8')
+
+
+def decode_info(data):
+    info = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
+    for field, value in iter_fields(data):
+        info[field] = value
+    return signed(info[1]), signed(info[2]), signed(info[3]), signed(info[4]), info[5]
+
+
+EMPTY_INFO = dict((attrib, '') for attrib in ('version', 'timestamp', 'changeset', 'uid', 'user'))
+
+
+def decode_node(block, data):
+    fields = {}
+    keys = vals = []
+    for field, value in iter_fields(data):
+        if field == 2:
+            keys = packed_varints(value)
+        elif field == 3:
+            vals = packed_varints(value)
+        else:
+            fields[field] = value
+    attrib = block.info_attrib(*decode_info(fields[4])) if 4 in fields else dict(EMPTY_INFO)
+    attrib['id'] = str(zigzag(fields[1]))
+    attrib['lat'] = block.lat(zigzag(fields.get(8, 0)))
+    attrib['lon'] = block.lon(zigzag(fields.get(9, 0)))
+    return ('node', attrib, block.tags(keys, vals), None)
+
+
+def decode_dense(block, data):
+    ''' Decode a DenseNodes message, a whole block of nodes at a time'''
+    packed = dict(iter_fields(data))
+    if np is not None:
+        sint, varints = np_packed_sint, lambda raw: np_packed_varints(raw).astype(np.int64)
+    else:
+        sint, varints = packed_sint, packed_varints
+    ids = sint(packed.get(1, ''), delta=True)
+    lats = sint(packed.get(8, ''), delta=True)
+    lons = sint(packed.get(9, ''), delta=True)
+    if np is not None:
+        lats = (block.lat_offset + block.granularity * lats) * 1e-9
+        lons = (block.lon_offset + block.granularity * lons) * 1e-9
+        ids, lats, lons = ids.tolist(), lats.tolist(), lons.tolist()
+    else:
+        lats = [1e-9 * (block.lat_offset + block.granularity * lat) for lat in lats]
+        lons = [1e-9 * (block.lon_offset + block.granularity * lon) for lon in lons]
+
+    infos = None
+    if 5 in packed:
+        dense_info = dict(iter_fields(packed[5]))
+        versions = varints(dense_info.get(1, ''))
+        timestamps = sint(dense_info.get(2, ''), delta=True)
+        changesets = sint(dense_info.get(3, ''), delta=True)
+        uids = sint(dense_info.get(4, ''), delta=True)
+        user_sids = sint(dense_info.get(5, ''), delta=True)
+        if np is not None:
+            timestamps = timestamps * block.date_granularity // 1000
+            versions, timestamps, changesets, uids, user_sids = [
+                array.tolist() for array in (versions, timestamps, changesets, uids, user_sids)]
+        else:
+            timestamps = [timestamp * block.date_granularity // 1000 for timestamp in timestamps]
+        infos = zip(versions, timestamps, changesets, uids, user_sids)
+
+    keys_vals = varints(packed.get(10, ''))
+    if np is not None:
+        keys_vals = keys_vals.tolist()
+    strings = block.strings
+    kv_pos = 0
+    nodes = []
+    for idx, node_id in enumerate(ids):
+        if infos is not None:
+            version, timestamp, changeset, uid, user_sid = infos[idx]
+            attrib = { 'version': str(version),
+                       'timestamp': time.strftime(TIMESTAMP_FORMAT, time.gmtime(timestamp)),
+                       'changeset': str(changeset),
+                       'uid': str(uid),
+                       'user': strings[user_sid] }
+        else:
+            attrib = dict(EMPTY_INFO)
+        attrib['id'] = str(node_id)
+        attrib['lat'] = COORDINATE_FORMAT % lats[idx]
+        attrib['lon'] = COORDINATE_FORMAT % lons[idx]
+        tags = []
+        if keys_vals:
+            while keys_vals[kv_pos] != 0:
+                tags.append((strings[keys_vals[kv_pos]], strings[keys_vals[kv_pos + 1]]))
+                kv_pos += 2
+            kv_pos += 1
+        nodes.append(('node', attrib, tags, None))
+    return nodes
+
+
+def decode_way(block, data):
+    fields = {}
+    keys = vals = refs = []
+    for field, value in iter_fields(data):
+        if field == 2:
+            keys = packed_varints(value)
+        elif field == 3:
+            vals = packed_varints(value)
+        elif field == 8:
+            refs = packed_sint(value, delta=True)
+        else:
+            fields[field] = value
+    attrib = block.info_attrib(*decode_info(fields[4])) if 4 in fields else dict(EMPTY_INFO)
+    attrib['id'] = str(signed(fields[1]))
+    return ('way', attrib, block.tags(keys, vals), [str(ref) for ref in refs])
+
+
+def blob_data(blob):
+    ''' Uncompressed content of a Blob message'''
+    fields = dict(iter_fields(blob))
+    if 1 in fields:
+        return fields[1]
+    if 3 in fields:
+        return zlib.decompress(fields[3])
+    if 4 in fields:
+        return import_lzma("Reading LZMA compressed PBF blobs").decompress(fields[4])
+    raise ValueError("Unsupported PBF blob compression")
+
+
+def decode_block(args):
+    ''' Decode an OSMData blob, run in the worker processes
+        param: args tuple with the raw blob and the tags wanted i.e ('node', 'way')
+        return: list of (tag, attrib, tags, refs) of the elements in the block
+    '''
+    blob, tags = args
+    block = Block()
+    groups = []
+    for field, value in iter_fields(blob_data(blob)):
+        if field == 1:
+            block.strings = [decode_string(s) for _, s in iter_fields(value)]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            block.granularity = value
+        elif field == 18:
+            block.date_granularity = value
+        elif field == 19:
+            block.lat_offset = signed(value)
+        elif field == 20:
+            block.lon_offset = signed(value)
+
+    elements = []
+    for group in groups:
+        for field, value in iter_fields(group):
+            if field == 1 and 'node' in tags:
+                elements.append(decode_node(block, value))
+            elif field == 2 and 'node' in tags:
+                elements.extend(decode_dense(block, value))
+            elif field == 3 and 'way' in tags:
+                elements.append(decode_way(block, value))
+    return elements
+
+
+# ================================================== #
+#               Elements                             #
+# ================================================== #
+class PBFChild(object):
+    ''' <tag> or <nd> of an element'''
+    __slots__ = ('tag', 'attrib')
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+
+
+class PBFElement(object):
+    ''' Node or way with the interface of the XML elements read by shape_element'''
+    __slots__ = ('tag', 'attrib', 'tags', 'refs')
+
+    def __init__(self, tag, attrib, tags, refs):
+        self.tag = tag
+        self.attrib = attrib
+        self.tags = tags
+        self.refs = refs
+
+    def iter(self, tag=None):
+        if tag in (None, 'tag'):
+            for k, v in self.tags:
+                yield PBFChild('tag', {'k': k, 'v': v})
+        if tag in (None, 'nd') and self.refs:
+            for ref in self.refs:
+                yield PBFChild('nd', {'ref': ref})
+
+
+def read_blobs(pbf_file):
+    ''' Yield (type, raw blob) of each blob of the file'''
+    while True:
+        size = pbf_file.read(4)
+        if len(size) < 4:
+            return
+        header = dict(iter_fields(pbf_file.read(struct.unpack('!I', size)[0])))
+        yield header[1], pbf_file.read(header[3])
+
+
+def is_pbf(path):
+    return isinstance(path, basestring) and path.endswith('.pbf')
+
+
+def get_pbf_element(pbf_path, tags=('node', 'way'), workers=WORKERS):
+    ''' Yield the nodes and ways of the .osm.pbf file in file order
+        param: pbf_path to the .osm.pbf file
+        param: tags to yield, 'relation' is not supported and ignored
+        param: workers number of processes decoding blocks, 1 decodes in this process
+    '''
+    with open(pbf_path, 'rb') as pbf_file:
+        blocks = ((blob, tags) for blob_type, blob in read_blobs(pbf_file) if blob_type == 'OSMData')
+        if workers <= 1:
+            for block in blocks:
+                for element in decode_block(block):
+                    yield PBFElement(*element)
+            return
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            pending = deque()
+            for block in blocks:
+                pending.append(pool.apply_async(decode_block, (block,)))
+                if len(pending) >= workers * MAX_IN_FLIGHT:
+                    for element in pending.popleft().get():
+                        yield PBFElement(*element)
+            while pending:
+                for element in pending.popleft().get():
+                    yield PBFElement(*element)
+        finally:
+            pool.terminate()
+            pool.join()
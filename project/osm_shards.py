@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Split an OSM XML file into byte ranges that start and end on top level
+element boundaries (<node>, <way>, <relation>), so each range can be parsed
+on its own by a different process.
+
+Each shard is exposed as a small file-like object that replays the original
+XML declaration and <osm> start tag before the byte range and closes the
+root afterwards, so ET.iterparse sees a well formed document.
+'''
+import mmap
+import re
+
+# Top level elements in OSM XML are never nested, so the start of any of
+# these tags is a safe place to cut the file.
+TOP_LEVEL_RE = re.compile(r'<(?:node|way|relation)[\s/>]')
+OSM_ROOT_RE = re.compile(r'<osm[\s>/]')
+OSM_FOOTER = '</osm>\n'
+
+
+def find_shards(osm_file, count):
+    ''' Find the byte ranges to split osm_file into
+        param: osm_file path to the OSM XML file
+        param: count number of shards wanted, fewer are returned if the file is small
+        return: header bytes to replay before each shard, list of (start, end) offsets
+    '''
+    with open(osm_file, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            root = OSM_ROOT_RE.search(mm)
+            if root is None:
+                raise ValueError("{} does not look like an OSM XML file".format(osm_file))
+            header_end = mm.find('>', root.end() - 1) + 1
+            header = mm[:header_end]
+            body_end = mm.rfind('</osm>')
+            if body_end < header_end:
+                body_end = len(mm)
+
+            starts = []
+            body_size = body_end - header_end
+            for idx in range(max(count, 1)):
+                offset = header_end + body_size * idx // max(count, 1)
+                m = TOP_LEVEL_RE.search(mm, offset, body_end)
+                if m is None:
+                    break
+                if not starts or m.start() > starts[-1]:
+                    starts.append(m.start())
+        finally:
+            mm.close()
+
+    ends = starts[1:] + [body_end]
+    return header, zip(starts, ends)
+
+
+class ShardReader(object):
+    ''' Read only file-like object over one shard of an OSM file '''
+
+    def __init__(self, osm_file, start, end, header, footer=OSM_FOOTER):
+        self._file = open(osm_file, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+        self._head = header
+        self._tail = footer
+
+    def read(self, size=-1):
+        if self._head:
+            chunk, self._head = self._head, ''
+            return chunk
+        if self._remaining > 0:
+            if size is None or size < 0:
+                size = self._remaining
+            chunk = self._file.read(min(size, self._remaining))
+            self._remaining -= len(chunk)
+            if chunk:
+                return chunk
+            self._remaining = 0
+        chunk, self._tail = self._tail, ''
+        return chunk
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Bounding box and nearest neighbour lookups over the nodes and the ways of the db,
+through the rtree indexes of spatial.sql (nodes_rtree and ways_rtree). The rtree
+stores float32 values, it only picks the candidates: the rows are filtered on and
+return the exact coordinates of the nodes and the envelopes of way_geometry.
+
+Every function takes a connection and returns rows, col_names as the queries of
+dublin_queries, the bbox is (min_lat, min_lon, max_lat, max_lon) in degrees:
+
+  - nodes_in_bbox: nodes inside the bbox, optionally with a tag i.e amenity=pub
+  - ways_in_bbox: ways whose envelope intersects the bbox
+  - nearest_nodes / nearest_ways: the k closest to a point, in meters
+
+There is no nearest neighbour search in the rtree module, so the nearest lookups
+search a box around the point, doubling its size until it holds k candidates
+within the radius the box is sure to cover. The distance to a way is the one
+to its envelope.
+
+i.e rows, col_names = nearest_nodes(connection, 53.3498, -6.2603, k=5, tag=('amenity', 'pub'))
+'''
+import math
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+# first radius of the nearest lookups and the largest one, beyond the extent of a city extract
+START_RADIUS = 250.0
+MAX_RADIUS = 100000.0
+K = 5
+
+NODE_COLUMNS = ['id', 'lat', 'lon', 'name']
+WAY_COLUMNS = ['id', 'min_lat', 'min_lon', 'max_lat', 'max_lon', 'name']
+
+NODES_SQL = '''
+select n.id, n.lat, n.lon,
+       (select value from nodes_tags t where t.id = n.id and +t.key = 'name' and t.type = 'regular' limit 1) as name
+  from nodes_rtree r join nodes n on n.id = r.id
+ where r.min_lat <= ? and r.max_lat >= ? and r.min_lon <= ? and r.max_lon >= ?
+   and n.lat between ? and ? and n.lon between ? and ?
+'''
+NODES_TAG_SQL = ''' and exists (select 1 from nodes_tags t where t.id = n.id and +t.key = ? and t.value = ?)'''
+
+WAYS_SQL = '''
+select g.id, g.min_lat, g.min_lon, g.max_lat, g.max_lon,
+       (select value from ways_tags t where t.id = g.id and +t.key = 'name' and t.type = 'regular' limit 1) as name
+  from ways_rtree r join way_geometry g on g.id = r.id
+ where r.min_lat <= ? and r.max_lat >= ? and r.min_lon <= ? and r.max_lon >= ?
+   and g.min_lat <= ? and g.max_lat >= ? and g.min_lon <= ? and g.max_lon >= ?
+'''
+WAYS_TAG_SQL = ''' and exists (select 1 from ways_tags t where t.id = r.id and +t.key = ? and t.value = ?)'''
+
+
+def parse_tag(value):
+    ''' return: (key, value) of a key=value tag, the key without its type prefix as stored in the db
+                i.e addr:street=Dame St is ('street', 'Dame St')
+    '''
+    key, value = value.split('=', 1)
+    return key.split(':', 1)[-1], value
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    ''' return: distance in meters between two points'''
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bbox_around(lat, lon, radius):
+    ''' return: bbox that holds every point within radius meters of lat, lon'''
+    dlat = radius / METERS_PER_DEGREE
+    # the degrees of longitude are the shortest at the latitude farthest from the equator
+    cos_lat = math.cos(math.radians(min(89.9, abs(lat) + dlat)))
+    dlon = min(180.0, radius / (METERS_PER_DEGREE * cos_lat))
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+
+def bbox_params(bbox):
+    ''' return: parameters of the overlap test of NODES_SQL and WAYS_SQL'''
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return [max_lat, min_lat, max_lon, min_lon]
+
+
+def nodes_in_bbox(connection, bbox, tag=None):
+    ''' Nodes inside the bbox
+        param: tag (key, value) the nodes must have, any node if None
+        return: rows of id, lat, lon, name, col_names
+    '''
+    min_lat, min_lon, max_lat, max_lon = bbox
+    sql, params = NODES_SQL, bbox_params(bbox) + [min_lat, max_lat, min_lon, max_lon]
+    if tag is not None:
+        sql, params = sql + NODES_TAG_SQL, params + list(tag)
+    return connection.execute(sql, params).fetchall(), list(NODE_COLUMNS)
+
+
+def ways_in_bbox(connection, bbox, tag=None):
+    ''' Ways whose envelope intersects the bbox
+        param: tag (key, value) the ways must have, any way if None
+        return: rows of id, envelope, name, col_names
+    '''
+    sql, params = WAYS_SQL, bbox_params(bbox) * 2
+    if tag is not None:
+        sql, params = sql + WAYS_TAG_SQL, params + list(tag)
+    return connection.execute(sql, params).fetchall(), list(WAY_COLUMNS)
+
+
+def envelope_distance(lat, lon, min_lat, min_lon, max_lat, max_lon):
+    ''' return: distance in meters from the point to the closest point of the envelope, 0 inside'''
+    return haversine(lat, lon, min(max(lat, min_lat), max_lat), min(max(lon, min_lon), max_lon))
+
+
+def nearest(lookup, distance, lat, lon, k, start_radius, max_radius):
+    ''' Grow the box around the point until it holds the k closest rows
+        param: lookup(bbox) returns the rows of the box, col_names
+        param: distance(row) returns the meters from the point to the row
+        return: the k closest rows with their distance appended, col_names + distance_m
+    '''
+    radius = start_radius
+    while True:
+        rows, col_names = lookup(bbox_around(lat, lon, radius))
+        found = sorted((distance(row), row) for row in rows)
+        # the box holds every row within radius, closer rows outside of it can not exist
+        within = [pair for pair in found if pair[0] <= radius]
+        if len(within) >= k or radius >= max_radius:
+            closest = within if len(within) >= k else found
+            return [tuple(row) + (round(meters, 1),) for meters, row in closest[:k]], col_names + ['distance_m']
+        radius *= 2
+
+
+def nearest_nodes(connection, lat, lon, k=K, tag=None, start_radius=START_RADIUS, max_radius=MAX_RADIUS):
+    ''' The k nodes closest to lat, lon (within max_radius meters)
+        param: tag (key, value) the nodes must have i.e ('amenity', 'pub'), any node if None
+        return: rows of id, lat, lon, name, distance_m sorted by distance, col_names
+    '''
+    return nearest(lambda bbox: nodes_in_bbox(connection, bbox, tag),
+                   lambda row: haversine(lat, lon, row[1], row[2]),
+                   lat, lon, k, start_radius, max_radius)
+
+
+def nearest_ways(connection, lat, lon, k=K, tag=None, start_radius=START_RADIUS, max_radius=MAX_RADIUS):
+    ''' The k ways whose envelope is closest to lat, lon (within max_radius meters)
+        param: tag (key, value) the ways must have i.e ('highway', 'residential'), any way if None
+        return: rows of id, envelope, name, distance_m sorted by distance, col_names
+    '''
+    return nearest(lambda bbox: ways_in_bbox(connection, bbox, tag),
+                   lambda row: envelope_distance(lat, lon, *row[1:5]),
+                   lat, lon, k, start_radius, max_radius)
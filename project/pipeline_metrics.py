@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Progress metrics and profiling of process_map.
+
+Metrics counts the elements, tags and way nodes shaped, the seconds spent in
+each stage (parse, shape, validate, write) and the bytes read from the input,
+to estimate the percent done. Every interval seconds a snapshot is printed to
+stderr, or appended as a JSON line to a metrics file:
+
+    [shard 2] 41.3% 1,250,000 elements 38,211/s, tags 52,870/s, way nodes 61,034/s | parse 14.2s ...
+
+The shards of a parallel run only print their interval snapshots, the final
+one is taken once from their summaries merged (summary_snapshot).
+
+profiling runs a block under cProfile ('cprofile') or a sampling profiler
+('sampling'), that samples the running function every few milliseconds with
+SIGPROF and costs far less than cProfile on long runs.
+'''
+import os
+import sys
+import json
+import time
+import signal
+import cProfile
+import pstats
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+
+STAGES = ('parse', 'shape', 'validate', 'write')
+COUNTERS = ('elements', 'tags', 'way_nodes')
+INTERVAL = 10
+# elements between two checks of the clock for a snapshot
+CHECK_EVERY = 1000
+SAMPLING_INTERVAL = 0.005
+PROFILERS = ('cprofile', 'sampling')
+
+
+class CountingReader(object):
+    ''' File-like object counting the bytes read from another one'''
+
+    def __init__(self, f):
+        self.file = f
+        self.offset = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.offset += len(data)
+        return data
+
+
+class Metrics(object):
+    ''' Counters and stage times of one process_map run, or of one shard of it'''
+
+    def __init__(self, label=None, interval=INTERVAL, output=None, total_bytes=None):
+        ''' param: label of the snapshots i.e the shard number
+            param: interval seconds between snapshots, None to only take the final one
+            param: output path of the file to append the snapshots to as JSON lines, stderr if None
+            param: total_bytes size of the input, to estimate the percent done
+        '''
+        self.label = label
+        self.interval = interval
+        self.output = output
+        self.total_bytes = total_bytes
+        self.reader = None
+        self.counts = dict((name, 0) for name in COUNTERS)
+        self.seconds = OrderedDict((stage, 0.0) for stage in STAGES)
+        self.start = self.last = time.time()
+        self.next_check = CHECK_EVERY
+
+    def track(self, f):
+        ''' return: f wrapped to count the bytes read from it'''
+        self.reader = CountingReader(f)
+        return self.reader
+
+    def add(self, elements=0, tags=0, way_nodes=0):
+        counts = self.counts
+        counts['elements'] += elements
+        counts['tags'] += tags
+        counts['way_nodes'] += way_nodes
+        if counts['elements'] >= self.next_check:
+            self.next_check += CHECK_EVERY
+            now = time.time()
+            if self.interval is not None and now - self.last >= self.interval:
+                self.last = now
+                self.emit()
+
+    def percent(self):
+        if not self.total_bytes or self.reader is None:
+            return None
+        return min(100.0, 100.0 * self.reader.offset / self.total_bytes)
+
+    def snapshot(self):
+        elapsed = time.time() - self.start
+        return { 'label': self.label,
+                 'time': time.time(),
+                 'elapsed': elapsed,
+                 'percent': self.percent(),
+                 'bytes': self.reader.offset if self.reader is not None else None,
+                 'counts': dict(self.counts),
+                 'per_second': dict((name, count / elapsed if elapsed else 0.0)
+                                    for name, count in self.counts.iteritems()),
+                 'seconds': dict(self.seconds) }
+
+    def emit(self, final=False):
+        snapshot = self.snapshot()
+        snapshot['final'] = final
+        write_snapshot(snapshot, self.output)
+
+    def summary(self):
+        ''' return: counts and stage seconds, to be merged with merge_summaries'''
+        return { 'counts': dict(self.counts),
+                 'seconds': dict(self.seconds),
+                 'elapsed': time.time() - self.start }
+
+
+def write_snapshot(snapshot, output=None):
+    ''' Print the snapshot to stderr, or append it as a JSON line to the output file if not None'''
+    if output is None:
+        sys.stderr.write(format_snapshot(snapshot) + '\n')
+    else:
+        with open(output, 'a') as f:
+            f.write(json.dumps(snapshot) + '\n')
+
+
+def summary_snapshot(summary):
+    ''' return: final snapshot of a finished run from its summary i.e merged over the shards'''
+    elapsed = summary['elapsed']
+    return { 'label': None,
+             'time': time.time(),
+             'elapsed': elapsed,
+             'percent': 100.0,
+             'bytes': None,
+             'counts': dict(summary['counts']),
+             'per_second': dict((name, count / elapsed if elapsed else 0.0)
+                                for name, count in summary['counts'].iteritems()),
+             'seconds': dict(summary['seconds']),
+             'final': True }
+
+
+def format_snapshot(snapshot):
+    percent = snapshot['percent']
+    rates = snapshot['per_second']
+    return "{}{}{:,d} elements {:,.0f}/s, tags {:,.0f}/s, way nodes {:,.0f}/s | {}".format(
+        "[shard {}] ".format(snapshot['label']) if snapshot['label'] is not None else '',
+        "{:.1f}% ".format(percent) if percent is not None else '',
+        snapshot['counts']['elements'], rates['elements'], rates['tags'], rates['way_nodes'],
+        ' '.join("{} {:.1f}s".format(stage, snapshot['seconds'][stage]) for stage in STAGES))
+
+
+def merge_summaries(summaries):
+    ''' Add up the summaries of several shards, elapsed is the longest of them'''
+    return { 'counts': dict((name, sum(summary['counts'][name] for summary in summaries)) for name in COUNTERS),
+             'seconds': dict((stage, sum(summary['seconds'][stage] for summary in summaries)) for stage in STAGES),
+             'elapsed': max([summary['elapsed'] for summary in summaries] or [0.0]) }
+
+
+def report(summary):
+    ''' Print the totals and the share of the time spent in each stage'''
+    counts, seconds = summary['counts'], summary['seconds']
+    total = sum(seconds.values())
+    print "Shaped {:,d} elements, {:,d} tags, {:,d} way nodes in {:.1f}s".format(
+        counts['elements'], counts['tags'], counts['way_nodes'], summary['elapsed'])
+    for stage in STAGES:
+        print "{:<10} {:>9.1f}s {:>6.1%}".format(stage, seconds[stage], seconds[stage] / total if total else 0.0)
+
+
+class SamplingProfiler(object):
+    ''' Count the function running every interval seconds of cpu time'''
+
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+        self.previous = None
+
+    def sample(self, signum, frame):
+        if frame is not None:
+            code = frame.f_code
+            self.samples[(code.co_filename, code.co_firstlineno, code.co_name)] += 1
+
+    def start(self):
+        self.previous = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous or signal.SIG_DFL)
+
+    def report(self, out, limit=20):
+        total = sum(self.samples.values())
+        out.write("{:,d} samples every {:.0f}ms\n".format(total, self.interval * 1000))
+        for (filename, line, name), count in self.samples.most_common(limit):
+            out.write("{:>6.1%} {:>8,d}  {} ({}:{})\n".format(float(count) / total, count, name, filename, line))
+
+
+def profile_file(directory, profiler, label=None, name='process_map'):
+    ''' return: path of the profile of a run in directory, process_map[.label].prof (cprofile)
+                or .txt (sampling), None without profiler
+    '''
+    if profiler is None:
+        return None
+    suffix = '.{}'.format(label) if label is not None else ''
+    return os.path.join(directory, "{}{}.{}".format(name, suffix, 'prof' if profiler == 'cprofile' else 'txt'))
+
+
+@contextmanager
+def profiling(profiler=None, path=None, limit=20):
+    ''' Profile the block with profiler, nothing is done if None
+        param: profiler 'cprofile' or 'sampling'
+        param: path to write the profile to, pstats file for cprofile and text for sampling
+        param: limit functions printed to stderr
+    '''
+    if profiler is None:
+        yield
+        return
+    if profiler not in PROFILERS:
+        raise ValueError("Unknown profiler {}, use one of {}".format(profiler, ', '.join(PROFILERS)))
+
+    if profiler == 'cprofile':
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            if path is not None:
+                prof.dump_stats(path)
+            pstats.Stats(prof, stream=sys.stderr).sort_stats('cumulative').print_stats(limit)
+    else:
+        sampler = SamplingProfiler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            if path is not None:
+                with open(path, 'w') as f:
+                    sampler.report(f, limit=None)
+            sampler.report(sys.stderr, limit)
@@ -17,8 +17,15 @@ I have created a dictionary of queries with the following structure
     - the value value is a tuple with 2 elements:
         * 1st element is query to execute
         * 2nd element is a boolean that indicates if the query is enabled or not for execution.
+
+- the dictionary is ordered, ALL executes and prints the queries in this order.
+- the counts of rows, tag keys, streets and users are read from the summary tables
+  of summaries.sql, built by the load and kept up to date by triggers, not scanned.
+- the shape of the ways is read from way_geometry (geometry.sql), one row per way.
 '''
+from collections import OrderedDict
 
+# dublin_queries runs it next to consistency_checks.street_mismatches, which returns the same rows
 ways_vs_nodes = '''
 select nt.id as node_id, nt.value as node_value, wt.id as way_id, wt.value as way_value
   from (
@@ -33,12 +40,13 @@ where wt.key='street' and
       wt.value != nt.value;
 '''
 
-queries = {
-    'rows_per_table' : ('select count(*) as row_count from {}', True),
-    'count_unique_user_by_node' : ('select count(distinct(user)) as distinct_users from nodes;', True),
-    'nodes_most_used_keys': ("select a.* from ( select count(key) as count, key from nodes_tags group by key order by count desc ) a where a.count >= 1000;", True),
-    'nodes_count_of_streets': ("select count(value) as 'Number of Streets' from (select distinct(value) as value from nodes_tags where key='street');", True),
-    'ways_most_used_keys':  ("select a.* from ( select count(key) as count, key from ways_tags group by key order by count desc ) a where a.count >= 1000;", False),
-    'street_types': ("select distinct(value) as street from nodes_tags where key='street' and value not like '%Street' order by value asc;", True),
-    'ways_vs_nodes':(ways_vs_nodes, True)
-}
+queries = OrderedDict([
+    ('rows_per_table', ("select count as row_count from row_counts where tbl = '{}'", True)),
+    ('count_unique_user_by_node', ('select count(*) as distinct_users from user_counts;', True)),
+    ('nodes_most_used_keys', ("select count, key from tag_key_counts where tbl = 'nodes_tags' and count >= 1000 order by count desc;", True)),
+    ('nodes_count_of_streets', ("select count(*) as 'Number of Streets' from street_counts;", True)),
+    ('ways_most_used_keys', ("select count, key from tag_key_counts where tbl = 'ways_tags' and count >= 1000 order by count desc;", False)),
+    ('street_types', ("select value as street from street_counts where value not like '%Street' order by value asc;", True)),
+    ('ways_vs_nodes', (ways_vs_nodes, True)),
+    ('longest_ways', ("select id, points, round(length_m) as length_m, closed from way_geometry order by length_m desc limit 10;", True))
+])
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+On disk cache of query results, used by dublin_queries.
+
+Each result is stored in its own file named after the query text and the
+fingerprint of the db: its path, size and modification time (and the ones
+of its -wal file), so any load or change applied to the db makes the old
+results unreachable, they are evicted as the least recently used ones.
+
+The files of the cache are kept under max_bytes in total, a hit updates the
+modification time of its file, the oldest files are removed first.
+'''
+import os
+import hashlib
+import tempfile
+import threading
+import cPickle as pickle
+
+CACHE_DIR = '.query_cache'
+MAX_BYTES = 100 << 20
+SUFFIX = '.result'
+
+
+def db_fingerprint(db_file):
+    ''' return: string that changes whenever db_file is written'''
+    parts = [os.path.abspath(db_file)]
+    for path in (db_file, db_file + '-wal'):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append("{}:{}:{!r}".format(path, stat.st_size, stat.st_mtime))
+    return '|'.join(parts)
+
+
+class QueryCache(object):
+    ''' Results of the queries, keyed by the query text and the db fingerprint'''
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, statement, fingerprint):
+        key = hashlib.sha1(fingerprint + '\0' + statement.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, statement, fingerprint):
+        ''' return: rows, col_names of the cached result, None if it is not cached'''
+        path = self.path(statement, fingerprint)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            # most recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return result
+
+    def put(self, statement, fingerprint, rows, col_names):
+        ''' Store the result, results larger than max_bytes are not stored'''
+        data = pickle.dumps((rows, col_names), pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # readers see the whole file or none
+        os.rename(tmp, self.path(statement, fingerprint))
+        self.evict()
+
+    def entries(self):
+        ''' return: list of (mtime, size, path) of the cached results, oldest first'''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        ''' Remove the least recently used results until the cache fits in max_bytes'''
+        with self.lock:
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+    def clear(self):
+        with self.lock:
+            for _, _, path in self.entries():
+                os.remove(path)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
@@ -1,12 +1,48 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+'''
+Take a sample of an OSM file in one streaming pass.
 
-import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
+Sampling modes:
+ - every: take every k-th top level element
+ - reservoir: take exactly --size top level elements, chosen uniformly at random
+ - stratified: take --size top level elements, split between nodes, ways and
+   relations in fixed proportions (--proportions)
 
-OSM_FILE = "dublin.osm"  # Replace this with your osm file
+With --closed every node referenced by a sampled way is kept as well, so the
+sample is referentially closed. Nodes are spilled to a temporary sqlite file
+next to the sample while streaming, as they come before the ways that
+reference them, and so are the sampled ways and relations, the memory used
+does not grow with the sample.
+
+Random modes are seeded (--seed), the same file and options always give the
+same sample so validation runs on samples stay consistent.
+
+i.e python sample.py dublin.osm.bz2 -o sample.osm --mode reservoir --size 50000 --closed
+'''
+import os
+import random
+import itertools
+import sqlite3
+import argparse
+import tempfile
+from collections import namedtuple
+
+import xml.etree.cElementTree as ET
+
+from osm_input import open_osm
+
+OSM_FILE = "dublin.osm"  # Replace this with your osm file, it can be compressed (.bz2, .gz, .xz)
 SAMPLE_FILE = "sample.osm"
 
 k = 10 # Parameter: take every k-th top level element
+SIZE = 100000
+SEED = 42
+PROPORTIONS = {'node': 0.8, 'way': 0.18, 'relation': 0.02}
+MODES = ['every', 'reservoir', 'stratified']
+
+Item = namedtuple('Item', ['seq', 'tag', 'id', 'xml', 'refs'])
+
 
 def get_element(osm_file, tags=('node', 'way', 'relation')):
     """Yield element if it is the right type of tag
@@ -22,13 +58,214 @@ def get_element(osm_file, tags=('node', 'way', 'relation')):
             root.clear()
 
 
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
+def make_item(seq, elem):
+    ''' Serialize a sampled element, keeping the node refs of ways for --closed'''
+    refs = [nd.attrib['ref'] for nd in elem.iter('nd')] if elem.tag == 'way' else None
+    return Item(seq, elem.tag, elem.attrib.get('id'), ET.tostring(elem, encoding='utf-8'), refs)
+
+
+class EverySampler(object):
+    ''' Every k-th element, items are written as they come'''
+    streaming = True
+
+    def __init__(self, k=k):
+        self.k = k
+
+    def offer(self, seq, elem):
+        if seq % self.k == 0:
+            return make_item(seq, elem)
+        return None
+
+
+class ReservoirSampler(object):
+    ''' Exactly size elements chosen uniformly at random (algorithm R)'''
+    streaming = False
+
+    def __init__(self, size=SIZE, rnd=None):
+        self.size = size
+        self.rnd = rnd or random.Random(SEED)
+        self.items = []
+        self.count = 0
+
+    def offer(self, seq, elem):
+        self.count += 1
+        if len(self.items) < self.size:
+            item = make_item(seq, elem)
+            self.items.append(item)
+            return item
+        idx = self.rnd.randint(0, self.count - 1)
+        if idx < self.size:
+            item = make_item(seq, elem)
+            self.items[idx] = item
+            return item
+        return None
+
+    def selected(self):
+        return self.items
+
+
+class StratifiedSampler(object):
+    ''' size elements split by tag in fixed proportions, one reservoir per tag'''
+    streaming = False
+
+    def __init__(self, size=SIZE, proportions=PROPORTIONS, seed=SEED):
+        rnd = random.Random(seed)
+        self.reservoirs = dict((tag, ReservoirSampler(int(round(size * proportion)), rnd))
+                               for tag, proportion in proportions.iteritems())
+
+    def offer(self, seq, elem):
+        reservoir = self.reservoirs.get(elem.tag)
+        if reservoir is None:
+            return None
+        return reservoir.offer(seq, elem)
+
+    def selected(self):
+        return [item for reservoir in self.reservoirs.values() for item in reservoir.selected()]
+
+
+class NodeStore(object):
+    ''' Temporary sqlite file with every node and the sampled ways and relations, so a --closed
+        sample is written from the file instead of being held in memory
+        param: directory of the file, the temporary directory of the system if None
+    '''
+
+    def __init__(self, directory=None, batch_size=10000):
+        fd, self.path = tempfile.mkstemp(suffix='.db', prefix='sample_nodes_', dir=directory)
+        os.close(fd)
+        try:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute("PRAGMA journal_mode = OFF")
+            self.connection.execute("PRAGMA synchronous = OFF")
+            self.connection.execute("CREATE TABLE nodes (id INTEGER PRIMARY KEY, seq INTEGER, xml BLOB)")
+            self.connection.execute("CREATE TABLE wanted (id INTEGER PRIMARY KEY)")
+            self.connection.execute("CREATE TABLE kept (seq INTEGER PRIMARY KEY, xml BLOB)")
+        except:
+            os.remove(self.path)
+            raise
+        self.batch_size = batch_size
+        self.batch, self.wanted, self.kept = [], [], []
+
+    def add(self, seq, elem):
+        self.batch.append((int(elem.attrib['id']), seq, buffer(ET.tostring(elem, encoding='utf-8'))))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def keep(self, item):
+        ''' Keep a sampled item, a node by its id and the others with the nodes they reference'''
+        if item.tag == 'node':
+            self.wanted.append((int(item.id),))
+        else:
+            self.kept.append((item.seq, buffer(item.xml)))
+            self.wanted.extend((int(ref),) for ref in item.refs or [])
+        if len(self.kept) + len(self.wanted) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.connection.executemany("INSERT OR REPLACE INTO nodes VALUES (?,?,?)", self.batch)
+        self.connection.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", self.wanted)
+        self.connection.executemany("INSERT OR REPLACE INTO kept VALUES (?,?)", self.kept)
+        self.batch, self.wanted, self.kept = [], [], []
+
+    def nodes(self):
+        ''' Yield the xml of the kept nodes and of the nodes referenced by the kept items in file order'''
+        self.flush()
+        for (xml,) in self.connection.execute(
+                "SELECT xml FROM nodes WHERE id IN (SELECT id FROM wanted) ORDER BY seq"):
+            yield str(xml)
+
+    def items(self):
+        ''' Yield the xml of the kept ways and relations in file order'''
+        self.flush()
+        for (xml,) in self.connection.execute("SELECT xml FROM kept ORDER BY seq"):
+            yield str(xml)
+
+    def close(self):
+        self.connection.close()
+        os.remove(self.path)
+
+
+def sample(osm_file, sample_file, sampler, closed=False):
+    ''' Write a sample of osm_file to sample_file in one pass
+        param: osm_file path to the OSM file, it can be compressed
+        param: sample_file path to write the sample to, the NodeStore of closed is created next to it
+        param: sampler EverySampler, ReservoirSampler or StratifiedSampler
+        param: closed to add every node referenced by a sampled way
+        return: number of elements written
+    '''
+    store = None
+    written = 0
+    try:
+        if closed:
+            store = NodeStore(os.path.dirname(os.path.abspath(sample_file)))
+        with open(sample_file, 'wb') as output:
+            output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            output.write('<osm>\n  ')
+
+            with open_osm(osm_file) as f:
+                for seq, element in enumerate(get_element(f)):
+                    if store is not None and element.tag == 'node':
+                        store.add(seq, element)
+                    item = sampler.offer(seq, element)
+                    if item is not None and sampler.streaming:
+                        if store is None:
+                            output.write(item.xml)
+                            written += 1
+                        else:
+                            store.keep(item)
+
+            # the random samplers hold at most their size in items
+            if not sampler.streaming:
+                for item in sorted(sampler.selected()):
+                    if store is None:
+                        output.write(item.xml)
+                        written += 1
+                    else:
+                        store.keep(item)
+            if store is not None:
+                # referenced nodes first, then the rest of the sample, as in the OSM files
+                for xml in itertools.chain(store.nodes(), store.items()):
+                    output.write(xml)
+                    written += 1
+
+            output.write('</osm>')
+    finally:
+        if store is not None:
+            store.close()
+    return written
+
+
+def parse_proportions(value):
+    ''' i.e node=0.8,way=0.18,relation=0.02'''
+    proportions = {}
+    for pair in value.split(','):
+        tag, proportion = pair.split('=')
+        proportions[tag.strip()] = float(proportion)
+    return proportions
+
+
+def main():
+    ''' Cli to take a sample of an OSM file'''
+    parser = argparse.ArgumentParser(description='Take a sample of an OSM file in one pass', prog='sample')
+    parser.add_argument('osm_file', nargs='?', default=OSM_FILE, help='OSM file to sample, it can be compressed')
+    parser.add_argument('-o', '--output', default=SAMPLE_FILE, help='sample file to write')
+    parser.add_argument('--mode', choices=MODES, default='every', help='sampling mode')
+    parser.add_argument('-k', type=int, default=k, help='every mode: take every k-th top level element')
+    parser.add_argument('--size', type=int, default=SIZE, help='reservoir and stratified modes: elements to take')
+    parser.add_argument('--proportions', type=parse_proportions, default=PROPORTIONS,
+                        help='stratified mode: proportion of each tag i.e node=0.8,way=0.18,relation=0.02')
+    parser.add_argument('--closed', action='store_true', help='keep every node referenced by a sampled way')
+    parser.add_argument('--seed', type=int, default=SEED, help='seed of the random modes')
+    args = parser.parse_args()
+
+    if args.mode == 'every':
+        sampler = EverySampler(args.k)
+    elif args.mode == 'reservoir':
+        sampler = ReservoirSampler(args.size, random.Random(args.seed))
+    else:
+        sampler = StratifiedSampler(args.size, args.proportions, args.seed)
+    written = sample(args.osm_file, args.output, sampler, args.closed)
+    print "Wrote {} elements to {}".format(written, args.output)
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
 
-    output.write('</osm>')
+if __name__ == '__main__':
+    main()
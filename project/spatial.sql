@@ -0,0 +1,38 @@
+-- R*Tree indexes of the nodes and of the envelopes (bounding boxes) of the ways, for the
+-- bbox and nearest neighbour lookups of osm_spatial.py. They are built once the rows are
+-- loaded, after the way_geometry table of geometry.sql.
+-- nodes_rtree is kept up to date by the triggers below. ways_rtree is a copy of the bbox
+-- of way_geometry, written by way_geometry.py whenever it builds or updates the rows of
+-- the ways, so the envelope of a way is only computed in one place.
+-- The rtree module stores 32 bit floats rounded outwards, it only picks the candidates,
+-- the lookups check the exact coordinates of the nodes and the bbox of way_geometry.
+
+DROP TABLE IF EXISTS nodes_rtree;
+DROP TABLE IF EXISTS ways_rtree;
+
+CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+CREATE VIRTUAL TABLE ways_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+
+INSERT INTO nodes_rtree (id, min_lat, max_lat, min_lon, max_lon)
+    SELECT id, lat, lat, lon, lon FROM nodes WHERE lat IS NOT NULL AND lon IS NOT NULL;
+INSERT INTO ways_rtree (id, min_lat, max_lat, min_lon, max_lon)
+    SELECT id, min_lat, max_lat, min_lon, max_lon FROM way_geometry WHERE points > 0;
+
+-- nodes: their point
+DROP TRIGGER IF EXISTS nodes_rtree_insert;
+CREATE TRIGGER nodes_rtree_insert AFTER INSERT ON nodes WHEN NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL BEGIN
+    INSERT OR REPLACE INTO nodes_rtree (id, min_lat, max_lat, min_lon, max_lon)
+        VALUES (NEW.id, NEW.lat, NEW.lat, NEW.lon, NEW.lon);
+END;
+
+DROP TRIGGER IF EXISTS nodes_rtree_delete;
+CREATE TRIGGER nodes_rtree_delete AFTER DELETE ON nodes BEGIN
+    DELETE FROM nodes_rtree WHERE id = OLD.id;
+END;
+
+DROP TRIGGER IF EXISTS nodes_rtree_update;
+CREATE TRIGGER nodes_rtree_update AFTER UPDATE OF lat, lon ON nodes BEGIN
+    DELETE FROM nodes_rtree WHERE id = OLD.id;
+    INSERT INTO nodes_rtree (id, min_lat, max_lat, min_lon, max_lon)
+        SELECT NEW.id, NEW.lat, NEW.lat, NEW.lon, NEW.lon WHERE NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL;
+END;
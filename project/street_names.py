@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Audit and normalisation of street names.
+
+The expected street types and the MAPPING of abbreviations are compiled into
+a trie of street type tokens read from the end of the name, so the longest
+expected suffix of a name, one or several words (i.e "Street Lower",
+"Road West"), is found in a single pass over its last tokens, with the
+abbreviations expanded on the way:
+
+    "Baggot St Lower" -> "Baggot Street Lower"
+    "Harcourt Rd."    -> "Harcourt Road"
+
+Only the street type suffix is rewritten, so "St Stephen's Green" is not
+turned into "Street Stephen's Green".
+
+Street names repeat across many tags, normalise_all works on the distinct
+names only and every StreetNormaliser keeps the names it has seen.
+
+The names found by the audit are turned once into a table of fixes
+(build_street_fixes), STREET_FIXES applies it to the addr:street values while
+the map is shaped, counting the values rewritten.
+'''
+import re
+import sys
+import time
+from collections import defaultdict
+
+street_type_re = re.compile(r'\b\S+\.?\s\b\S+\.?$', re.IGNORECASE)
+
+# Expected Street types to map
+expected = ["Street Lower", "Street", "Street Crescent", "Street Upper", "Street West", "Street East", "Street South","Street Little","Street North",
+            "Avenue", "Avenue Upper", "Avenue Lower", "Place East", "Place West","Place Little", "Mews","Place South","Street Great", "Village", "Paddock",
+            "Boulevard", "Drive", "Court", "Place", "Square", "Square North", "Square West", "Square East","Square South", "Lane",
+            "Trail", "Parkway", "Commons", "Villas", "Terrace", "Cottages", "Park", "Quay", "Hill", "Grove", "Avenue Lower", "Place North",
+            "Road Upper", "Road Lower", "Road", "Road West", "Road North", "Road South", "Road East",
+            "Street Upper", "Lane South", "Lane East", "Lane North", "Lane West", "Lawn", "Lane Upper",
+            "Grove North", "Grove South", "Dock", "Quay Lower", "Quay Upper", "Crescent", "Gardens", "Mews End", "View", "Place Upper"]
+EXPECTED = frozenset(expected)
+
+# If any mapping with the keys below appears we suggest a change to th values corresponding to that key
+MAPPING = { "St": "Street",
+            "St.": "Street",
+            "Rd.": "Road",
+            "Ave": "Avenue",
+            "Ln": "Lane",
+            "Rd": "Road"
+            }
+
+# marks the trie nodes where an expected street type ends
+END = None
+
+
+def build_suffix_trie(street_types=EXPECTED):
+    ''' Trie of the tokens of each street type, from the last token to the first'''
+    trie = {}
+    for street_type in street_types:
+        node = trie
+        for token in reversed(street_type.split(' ')):
+            node = node.setdefault(token, {})
+        node[END] = True
+    return trie
+
+
+def street_type_of(street_name):
+    ''' Unexpected street type of the name, as audited by audit_street_type
+        return: last two words of the name if the first one is an expected street
+                type and the second one is not, None otherwise
+    '''
+    m = street_type_re.search(street_name)
+    if m:
+        street_type = m.group()
+        if street_type in EXPECTED:
+            return None
+        split_street = street_type.split(' ')
+        if split_street[0] in EXPECTED and split_street[1] not in EXPECTED:
+            return street_type
+    return None
+
+
+class StreetNormaliser(object):
+    ''' Expand the abbreviations of the street type suffix of the names'''
+
+    def __init__(self, street_types=EXPECTED, mapping=MAPPING):
+        self.trie = build_suffix_trie(street_types)
+        self.mapping = mapping
+        self.cache = {}
+
+    def match(self, tokens):
+        ''' Longest expected street type at the end of tokens
+            return: number of tokens matched, list of the matched tokens expanded (last token first)
+        '''
+        node = self.trie
+        expanded = []
+        matched = 0
+        for token in reversed(tokens):
+            token = self.mapping.get(token, token)
+            node = node.get(token)
+            if node is None:
+                break
+            expanded.append(token)
+            if END in node:
+                matched = len(expanded)
+        return matched, expanded[:matched]
+
+    def normalise(self, name):
+        ''' return: name with the abbreviations of its street type expanded, unchanged if it has no expected type'''
+        try:
+            return self.cache[name]
+        except KeyError:
+            pass
+        tokens = name.split(' ')
+        matched, expanded = self.match(tokens)
+        if matched:
+            tokens[-matched:] = reversed(expanded)
+            normalised = ' '.join(tokens)
+        else:
+            normalised = name
+        self.cache[name] = normalised
+        return normalised
+
+    def normalise_all(self, names):
+        ''' Batch API, normalise the distinct names only
+            return: dictionary of name and normalised name
+        '''
+        return dict((name, self.normalise(name)) for name in set(names))
+
+
+NORMALISER = StreetNormaliser()
+
+
+def audit_names(names):
+    ''' Audit the distinct names of an iterable of street names
+        return: dictionary of unexpected street type and set of names, as dublin_openstreet.audit
+    '''
+    street_types = defaultdict(set)
+    for name in set(names):
+        street_type = street_type_of(name)
+        if street_type is not None:
+            street_types[street_type].add(name)
+    return street_types
+
+
+def build_street_fixes(names, normaliser=NORMALISER):
+    ''' Mapping table of the names the normaliser changes
+        param: names iterable of street names, i.e the ones collected by the audit
+        return: dictionary of name and fixed name
+    '''
+    return dict((name, fixed) for name, fixed in normaliser.normalise_all(names).iteritems() if fixed != name)
+
+
+class StreetFixes(object):
+    ''' Precomputed table of street name fixes, applied to the addr:street values while shaping'''
+
+    def __init__(self, fixes=None):
+        self.fixes = dict(fixes or {})
+        self.reset_stats()
+
+    def load(self, fixes):
+        ''' Replace the table of fixes, the counters are kept'''
+        self.fixes = dict(fixes)
+
+    def fix(self, name):
+        ''' return: fixed name from the table, name unchanged if it is not in it'''
+        self.checked += 1
+        fixed = self.fixes.get(name)
+        if fixed is None:
+            return name
+        self.rewritten += 1
+        return fixed
+
+    def reset_stats(self):
+        self.checked = self.rewritten = 0
+
+    def stats(self):
+        return make_fix_stats(self.checked, self.rewritten, len(self.fixes))
+
+    def report(self):
+        report_fixes(self.stats())
+
+
+def make_fix_stats(checked, rewritten, fixes):
+    return { 'checked': checked, 'rewritten': rewritten, 'fixes': fixes }
+
+
+def merge_fix_stats(all_stats):
+    ''' Add up the counters of several StreetFixes i.e one per worker process'''
+    return make_fix_stats(sum(stats['checked'] for stats in all_stats),
+                          sum(stats['rewritten'] for stats in all_stats),
+                          max([stats['fixes'] for stats in all_stats] or [0]))
+
+
+def report_fixes(stats):
+    print "Street fixes: {:,d} of {:,d} addr:street values rewritten, {:,d} names in the table".format(
+        stats['rewritten'], stats['checked'], stats['fixes'])
+
+
+# Applied by dublin_openstreet.update_tags, empty until a table is loaded
+STREET_FIXES = StreetFixes()
+
+
+def update_name_by_word(name, mapping=MAPPING):
+    ''' Previous update_name, fix the first word found in mapping, kept as benchmark baseline'''
+    names = name.split(' ')
+    for idx, word in enumerate(names):
+        if mapping.get(word):
+            names[idx] = mapping[word]
+            break
+    return ' '.join(names)
+
+
+def audit_street_type_by_list(street_types, street_name, expected=expected):
+    ''' Previous audit_street_type scanning the expected list, kept as benchmark baseline'''
+    m = street_type_re.search(street_name)
+    if m:
+        street_type = m.group()
+        split_street = street_type.split(' ')
+        if street_type in expected:
+            return
+        if (split_street[0] in expected and split_street[1] not in expected):
+            street_types[street_type].add(street_name)
+
+
+def benchmark(osm_file):
+    ''' Audit and normalise every addr:street value of osm_file, the previous way and with the trie'''
+    # imported here as dublin_openstreet imports this module
+    from dublin_openstreet import get_element, is_street_name
+
+    names = [tag.attrib['v'] for element in get_element(osm_file, tags=('node', 'way'))
+             for tag in element.iter('tag') if is_street_name(tag)]
+    print "{:,d} addr:street values, {:,d} distinct".format(len(names), len(set(names)))
+
+    start = time.time()
+    street_types = defaultdict(set)
+    for name in names:
+        audit_street_type_by_list(street_types, name)
+    previous = [update_name_by_word(name) for name in names]
+    previous_seconds = time.time() - start
+
+    start = time.time()
+    audited = audit_names(names)
+    normalised = StreetNormaliser().normalise_all(names)
+    trie_seconds = time.time() - start
+
+    changed = sum(1 for name in names if normalised[name] != name)
+    print "previous   {:>8.3f}s {:>10,d} names changed".format(
+        previous_seconds, sum(1 for name, fixed in zip(names, previous) if fixed != name))
+    print "trie       {:>8.3f}s {:>10,d} names changed".format(trie_seconds, changed)
+    print "same audit: {}".format(dict(street_types) == dict(audited))
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else 'dublin.osm')
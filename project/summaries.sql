@@ -0,0 +1,151 @@
+-- Summary tables read by the dashboard queries of queries.py instead of scanning the data.
+-- They are built from the loaded tables once the indexes exist, and kept up to date by the
+-- triggers below on every insert, delete and update (i.e the changes of osm_changes.py).
+-- Distinct values are kept with the number of rows that have them, so a value goes away
+-- when its last row is deleted.
+
+DROP TABLE IF EXISTS row_counts;
+DROP TABLE IF EXISTS tag_key_counts;
+DROP TABLE IF EXISTS street_counts;
+DROP TABLE IF EXISTS user_counts;
+
+-- rows of each table
+CREATE TABLE row_counts (
+    tbl TEXT PRIMARY KEY NOT NULL,
+    count INTEGER NOT NULL
+);
+
+-- rows of each tag key of nodes_tags and ways_tags
+CREATE TABLE tag_key_counts (
+    tbl TEXT NOT NULL,
+    key TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (tbl, key)
+);
+
+-- nodes_tags rows of each street (key = 'street')
+CREATE TABLE street_counts (
+    value TEXT PRIMARY KEY NOT NULL,
+    count INTEGER NOT NULL
+);
+
+-- nodes of each user
+CREATE TABLE user_counts (
+    user TEXT PRIMARY KEY NOT NULL,
+    count INTEGER NOT NULL
+);
+
+INSERT INTO row_counts (tbl, count) SELECT 'nodes', count(*) FROM nodes;
+INSERT INTO row_counts (tbl, count) SELECT 'nodes_tags', count(*) FROM nodes_tags;
+INSERT INTO row_counts (tbl, count) SELECT 'ways', count(*) FROM ways;
+INSERT INTO row_counts (tbl, count) SELECT 'ways_tags', count(*) FROM ways_tags;
+INSERT INTO row_counts (tbl, count) SELECT 'ways_nodes', count(*) FROM ways_nodes;
+INSERT INTO tag_key_counts (tbl, key, count)
+    SELECT 'nodes_tags', key, count(*) FROM nodes_tags WHERE key IS NOT NULL GROUP BY key;
+INSERT INTO tag_key_counts (tbl, key, count)
+    SELECT 'ways_tags', key, count(*) FROM ways_tags WHERE key IS NOT NULL GROUP BY key;
+INSERT INTO street_counts (value, count)
+    SELECT value, count(*) FROM nodes_tags WHERE key = 'street' AND value IS NOT NULL GROUP BY value;
+INSERT INTO user_counts (user, count)
+    SELECT user, count(*) FROM nodes WHERE user IS NOT NULL GROUP BY user;
+
+-- nodes: row count and users
+DROP TRIGGER IF EXISTS nodes_summary_insert;
+CREATE TRIGGER nodes_summary_insert AFTER INSERT ON nodes BEGIN
+    UPDATE row_counts SET count = count + 1 WHERE tbl = 'nodes';
+    INSERT OR IGNORE INTO user_counts (user, count) SELECT NEW.user, 0 WHERE NEW.user IS NOT NULL;
+    UPDATE user_counts SET count = count + 1 WHERE user = NEW.user;
+END;
+
+DROP TRIGGER IF EXISTS nodes_summary_delete;
+CREATE TRIGGER nodes_summary_delete AFTER DELETE ON nodes BEGIN
+    UPDATE row_counts SET count = count - 1 WHERE tbl = 'nodes';
+    UPDATE user_counts SET count = count - 1 WHERE user = OLD.user;
+    DELETE FROM user_counts WHERE user = OLD.user AND count <= 0;
+END;
+
+DROP TRIGGER IF EXISTS nodes_summary_update;
+CREATE TRIGGER nodes_summary_update AFTER UPDATE OF user ON nodes BEGIN
+    UPDATE user_counts SET count = count - 1 WHERE user = OLD.user;
+    DELETE FROM user_counts WHERE user = OLD.user AND count <= 0;
+    INSERT OR IGNORE INTO user_counts (user, count) SELECT NEW.user, 0 WHERE NEW.user IS NOT NULL;
+    UPDATE user_counts SET count = count + 1 WHERE user = NEW.user;
+END;
+
+-- nodes_tags: row count, keys and streets
+DROP TRIGGER IF EXISTS nodes_tags_summary_insert;
+CREATE TRIGGER nodes_tags_summary_insert AFTER INSERT ON nodes_tags BEGIN
+    UPDATE row_counts SET count = count + 1 WHERE tbl = 'nodes_tags';
+    INSERT OR IGNORE INTO tag_key_counts (tbl, key, count) SELECT 'nodes_tags', NEW.key, 0 WHERE NEW.key IS NOT NULL;
+    UPDATE tag_key_counts SET count = count + 1 WHERE tbl = 'nodes_tags' AND key = NEW.key;
+    INSERT OR IGNORE INTO street_counts (value, count)
+        SELECT NEW.value, 0 WHERE NEW.key = 'street' AND NEW.value IS NOT NULL;
+    UPDATE street_counts SET count = count + 1 WHERE NEW.key = 'street' AND value = NEW.value;
+END;
+
+DROP TRIGGER IF EXISTS nodes_tags_summary_delete;
+CREATE TRIGGER nodes_tags_summary_delete AFTER DELETE ON nodes_tags BEGIN
+    UPDATE row_counts SET count = count - 1 WHERE tbl = 'nodes_tags';
+    UPDATE tag_key_counts SET count = count - 1 WHERE tbl = 'nodes_tags' AND key = OLD.key;
+    DELETE FROM tag_key_counts WHERE tbl = 'nodes_tags' AND key = OLD.key AND count <= 0;
+    UPDATE street_counts SET count = count - 1 WHERE OLD.key = 'street' AND value = OLD.value;
+    DELETE FROM street_counts WHERE OLD.key = 'street' AND value = OLD.value AND count <= 0;
+END;
+
+DROP TRIGGER IF EXISTS nodes_tags_summary_update;
+CREATE TRIGGER nodes_tags_summary_update AFTER UPDATE OF key, value ON nodes_tags BEGIN
+    UPDATE tag_key_counts SET count = count - 1 WHERE tbl = 'nodes_tags' AND key = OLD.key;
+    DELETE FROM tag_key_counts WHERE tbl = 'nodes_tags' AND key = OLD.key AND count <= 0;
+    UPDATE street_counts SET count = count - 1 WHERE OLD.key = 'street' AND value = OLD.value;
+    DELETE FROM street_counts WHERE OLD.key = 'street' AND value = OLD.value AND count <= 0;
+    INSERT OR IGNORE INTO tag_key_counts (tbl, key, count) SELECT 'nodes_tags', NEW.key, 0 WHERE NEW.key IS NOT NULL;
+    UPDATE tag_key_counts SET count = count + 1 WHERE tbl = 'nodes_tags' AND key = NEW.key;
+    INSERT OR IGNORE INTO street_counts (value, count)
+        SELECT NEW.value, 0 WHERE NEW.key = 'street' AND NEW.value IS NOT NULL;
+    UPDATE street_counts SET count = count + 1 WHERE NEW.key = 'street' AND value = NEW.value;
+END;
+
+-- ways: row count
+DROP TRIGGER IF EXISTS ways_summary_insert;
+CREATE TRIGGER ways_summary_insert AFTER INSERT ON ways BEGIN
+    UPDATE row_counts SET count = count + 1 WHERE tbl = 'ways';
+END;
+
+DROP TRIGGER IF EXISTS ways_summary_delete;
+CREATE TRIGGER ways_summary_delete AFTER DELETE ON ways BEGIN
+    UPDATE row_counts SET count = count - 1 WHERE tbl = 'ways';
+END;
+
+-- ways_tags: row count and keys
+DROP TRIGGER IF EXISTS ways_tags_summary_insert;
+CREATE TRIGGER ways_tags_summary_insert AFTER INSERT ON ways_tags BEGIN
+    UPDATE row_counts SET count = count + 1 WHERE tbl = 'ways_tags';
+    INSERT OR IGNORE INTO tag_key_counts (tbl, key, count) SELECT 'ways_tags', NEW.key, 0 WHERE NEW.key IS NOT NULL;
+    UPDATE tag_key_counts SET count = count + 1 WHERE tbl = 'ways_tags' AND key = NEW.key;
+END;
+
+DROP TRIGGER IF EXISTS ways_tags_summary_delete;
+CREATE TRIGGER ways_tags_summary_delete AFTER DELETE ON ways_tags BEGIN
+    UPDATE row_counts SET count = count - 1 WHERE tbl = 'ways_tags';
+    UPDATE tag_key_counts SET count = count - 1 WHERE tbl = 'ways_tags' AND key = OLD.key;
+    DELETE FROM tag_key_counts WHERE tbl = 'ways_tags' AND key = OLD.key AND count <= 0;
+END;
+
+DROP TRIGGER IF EXISTS ways_tags_summary_update;
+CREATE TRIGGER ways_tags_summary_update AFTER UPDATE OF key ON ways_tags BEGIN
+    UPDATE tag_key_counts SET count = count - 1 WHERE tbl = 'ways_tags' AND key = OLD.key;
+    DELETE FROM tag_key_counts WHERE tbl = 'ways_tags' AND key = OLD.key AND count <= 0;
+    INSERT OR IGNORE INTO tag_key_counts (tbl, key, count) SELECT 'ways_tags', NEW.key, 0 WHERE NEW.key IS NOT NULL;
+    UPDATE tag_key_counts SET count = count + 1 WHERE tbl = 'ways_tags' AND key = NEW.key;
+END;
+
+-- ways_nodes: row count
+DROP TRIGGER IF EXISTS ways_nodes_summary_insert;
+CREATE TRIGGER ways_nodes_summary_insert AFTER INSERT ON ways_nodes BEGIN
+    UPDATE row_counts SET count = count + 1 WHERE tbl = 'ways_nodes';
+END;
+
+DROP TRIGGER IF EXISTS ways_nodes_summary_delete;
+CREATE TRIGGER ways_nodes_summary_delete AFTER DELETE ON ways_nodes BEGIN
+    UPDATE row_counts SET count = count - 1 WHERE tbl = 'ways_nodes';
+END;
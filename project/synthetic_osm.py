@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Deterministic generator of synthetic OSM XML files.
+
+The same seed and parameters always produce the same file, so it can be used
+to measure the pipeline on maps of any size without downloading one.
+
+i.e python synthetic_osm.py synthetic.osm 100000
+    writes 100000 nodes, 10000 ways and 1 relation every 100 ways
+'''
+import sys
+import random
+from StringIO import StringIO
+from xml.sax.saxutils import quoteattr
+
+SEED = 42
+
+STREETS = [u"O'Connell Street Upper", u"Grafton Street", u"Dame St", u"Baggot Street Lower",
+           u"Pearse Rd", u"Camden Street", u"Sr\xe1id an Phiarsaigh", u"Clanbrassil Street Lower",
+           u"Merrion Square North", u"Harcourt Rd.", u"Leeson Ave", u"Ormond Quay Upper"]
+
+# (key, weight, values) the weight is the relative frequency of the key
+KEYS = [('highway', 20, ['residential', 'service', 'footway', 'primary', 'bus_stop']),
+        ('name', 15, [u'Spar', u'Centra', u'Caf\xe9 en Seine', u'The Long Hall']),
+        ('building', 15, ['yes', 'house', 'apartments']),
+        ('addr:street', 10, STREETS),
+        ('addr:housenumber', 10, [str(n) for n in range(1, 200)]),
+        ('addr:city', 5, ['Dublin']),
+        ('amenity', 5, ['pub', 'cafe', 'restaurant', 'bench', 'parking']),
+        ('source', 5, ['survey', 'bing']),
+        ('name:ga', 3, [u'Baile \xc1tha Cliath']),
+        ('addr:street:name', 2, [u'Grafton']),
+        ('fixme name', 1, ['check']),
+        ('FIXME', 1, ['position'])]
+
+# Dublin bounding box
+BOUNDS = (53.2, -6.45, 53.45, -6.05)
+
+
+def weighted_keys(keys=KEYS):
+    ''' Expand the key weights into a list to pick keys with random.choice'''
+    return [(key, values) for key, weight, values in keys for _ in range(weight)]
+
+
+def write_tags(out, rnd, choices, tags_per_element):
+    for _ in range(rnd.randint(0, tags_per_element)):
+        key, values = rnd.choice(choices)
+        out.write((u'    <tag k=%s v=%s/>\n' % (quoteattr(key), quoteattr(rnd.choice(values)))).encode('utf-8'))
+
+
+def write_osm(out, nodes, ways, tags_per_element=4, nodes_per_way=8, keys=KEYS, seed=SEED):
+    ''' Write a synthetic OSM document to the file object out
+        param: nodes number of nodes
+        param: ways number of ways, each one referencing up to nodes_per_way nodes
+        param: tags_per_element max number of tags of each node and way
+        param: keys list of (key, weight, values) to pick the tags from
+        param: seed of the random generator
+    '''
+    rnd = random.Random(seed)
+    choices = weighted_keys(keys)
+    minlat, minlon, maxlat, maxlon = BOUNDS
+    users = [u'user%d' % idx for idx in range(500)] + [u'Se\xe1n', u'Aoife']
+
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.write('<osm version="0.6" generator="synthetic_osm">\n')
+    out.write(' <bounds minlat="%s" minlon="%s" maxlat="%s" maxlon="%s"/>\n' % BOUNDS)
+    for node_id in xrange(1, nodes + 1):
+        uid = rnd.randrange(len(users))
+        out.write((u' <node id="%d" lat="%.7f" lon="%.7f" version="%d" timestamp="2018-10-%02dT12:00:00Z" '
+                   u'changeset="%d" uid="%d" user=%s>\n' % (
+                       node_id, rnd.uniform(minlat, maxlat), rnd.uniform(minlon, maxlon),
+                       rnd.randint(1, 9), rnd.randint(1, 28), rnd.randint(1, 60000000),
+                       uid, quoteattr(users[uid]))).encode('utf-8'))
+        write_tags(out, rnd, choices, tags_per_element)
+        out.write(' </node>\n')
+    for way_id in xrange(1, ways + 1):
+        uid = rnd.randrange(len(users))
+        out.write((u' <way id="%d" version="%d" timestamp="2018-10-%02dT12:00:00Z" changeset="%d" '
+                   u'uid="%d" user=%s>\n' % (
+                       way_id, rnd.randint(1, 9), rnd.randint(1, 28), rnd.randint(1, 60000000),
+                       uid, quoteattr(users[uid]))).encode('utf-8'))
+        first = rnd.randint(1, max(nodes - nodes_per_way, 1))
+        for position in range(rnd.randint(2, nodes_per_way)):
+            out.write('    <nd ref="%d"/>\n' % min(first + position, nodes))
+        write_tags(out, rnd, choices, tags_per_element)
+        out.write(' </way>\n')
+    for relation_id in xrange(1, ways // 100 + 1):
+        out.write(' <relation id="%d" version="1" timestamp="2018-10-01T12:00:00Z" changeset="1" '
+                  'uid="1" user="user1">\n' % relation_id)
+        out.write('    <member type="way" ref="%d" role="outer"/>\n' % relation_id)
+        out.write('    <tag k="type" v="multipolygon"/>\n')
+        out.write(' </relation>\n')
+    out.write('</osm>\n')
+
+
+def generate(path, nodes, ways=None, **kwargs):
+    ''' Write a synthetic OSM file to path, by default with one way every 10 nodes'''
+    if ways is None:
+        ways = nodes // 10
+    with open(path, 'wb') as out:
+        write_osm(out, nodes, ways, **kwargs)
+    return path
+
+
+def nodes_for_size(size_mb, **kwargs):
+    ''' Estimate the number of nodes (with one way every 10 nodes) for a file of size_mb'''
+    sample = StringIO()
+    write_osm(sample, 10000, 1000, **kwargs)
+    return int(10000 * size_mb * (1 << 20) / float(len(sample.getvalue())))
+
+
+if __name__ == '__main__':
+    generate(sys.argv[1] if len(sys.argv) > 1 else 'synthetic.osm',
+             int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Memoised classification of the "k" attribute of <tag> elements.
+
+The same few thousand keys repeat across millions of tags, so each distinct
+key is classified once and the result is kept in a bounded cache:
+  - category: "lower", "lower_colon", "problemchars" or "other" (see lesson13/tags.py)
+  - problemchars: True if the key contains problematic chars
+  - key, type: the key split on the first ":" as done by split_key_type
+
+The cache is cleared when it reaches max_size, hits and misses are counted so
+the size can be tuned with report().
+'''
+import re
+from collections import namedtuple
+
+import xml.etree.cElementTree as ET
+
+from osm_input import open_osm
+
+LOWER = re.compile(r'^([a-z]|_)*$')
+LOWER_COLON = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
+PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+
+DEFAULT_TAG_TYPE = 'regular'
+CACHE_SIZE = 50000
+
+KeyClass = namedtuple('KeyClass', ['category', 'problemchars', 'key', 'type'])
+
+
+def classify_key(k, default_tag_type=DEFAULT_TAG_TYPE):
+    ''' Classify a tag key without caching
+        param: k the "k" attribute of the tag
+        return: KeyClass
+    '''
+    problemchars = PROBLEMCHARS.search(k) is not None
+    if LOWER.search(k):
+        category = 'lower'
+    elif LOWER_COLON.search(k):
+        category = 'lower_colon'
+    elif problemchars:
+        category = 'problemchars'
+    else:
+        category = 'other'
+
+    if ':' in k:
+        tag_type, key = k.split(':', 1)
+    else:
+        key, tag_type = k, default_tag_type
+    return KeyClass(category, problemchars, key, tag_type)
+
+
+class KeyClassifier(object):
+    ''' Bounded cache in front of classify_key'''
+
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def classify(self, k):
+        ''' return: KeyClass of k, from the cache when possible'''
+        try:
+            result = self.cache[k]
+            self.hits += 1
+            return result
+        except KeyError:
+            pass
+        self.misses += 1
+        if len(self.cache) >= self.max_size:
+            self.cache.clear()
+            self.evictions += 1
+        result = self.cache[k] = classify_key(k)
+        return result
+
+    def reset_stats(self):
+        ''' Reset the counters, the cached keys are kept'''
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return make_stats(self.hits, self.misses, self.evictions, len(self.cache))
+
+    def report(self):
+        ''' Print the cache hit rate to help sizing max_size'''
+        report(self.stats(), self.max_size)
+
+
+def make_stats(hits, misses, evictions, size):
+    lookups = hits + misses
+    return { 'hits': hits,
+             'misses': misses,
+             'evictions': evictions,
+             'size': size,
+             'hit_rate': float(hits) / lookups if lookups else 0.0 }
+
+
+def merge_stats(all_stats):
+    ''' Add up the stats of several classifiers i.e one per worker process
+        size is the largest cache of them
+    '''
+    return make_stats(sum(stats['hits'] for stats in all_stats),
+                      sum(stats['misses'] for stats in all_stats),
+                      sum(stats['evictions'] for stats in all_stats),
+                      max([stats['size'] for stats in all_stats] or [0]))
+
+
+def report(stats, max_size=CACHE_SIZE):
+    ''' Print the cache hit rate to help sizing the cache'''
+    print "Tag key cache: {:.1%} hit rate, {:,d} hits, {:,d} misses, {:,d} evictions, {:,d}/{:,d} keys".format(
+        stats['hit_rate'], stats['hits'], stats['misses'], stats['evictions'], stats['size'], max_size)
+
+
+# Shared by the audit and the shaping of dublin_openstreet
+KEYS = KeyClassifier()
+
+
+def key_type(element, keys, classifier=KEYS):
+    ''' Count the category of the tag element in keys
+        param: element to classify, only "tag" elements are counted
+        param: keys dictionary with the count of each category
+        return: keys
+    '''
+    if element.tag == "tag":
+        keys[classifier.classify(element.attrib['k']).category] += 1
+    return keys
+
+
+def audit_keys(filename, classifier=KEYS, streaming=True):
+    ''' Count the categories of every tag key in filename
+        With streaming the tree is cleared after each top level element
+        return: dictionary with the count of each category
+    '''
+    if isinstance(filename, basestring):
+        with open_osm(filename) as f:
+            return audit_keys(f, classifier, streaming)
+
+    keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
+    context = ET.iterparse(filename, events=('start', 'end'))
+    _, root = next(context)
+    for event, element in context:
+        if event == 'end':
+            key_type(element, keys, classifier)
+            if streaming and element.tag in ('node', 'way', 'relation'):
+                root.clear()
+    return keys
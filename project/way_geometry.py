@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Geometry of the ways, stored in the way_geometry table of geometry.sql.
+
+The coordinates of every way are assembled once, with one scan of ways_nodes
+in (id, position) order joined to nodes, and stored as a packed blob of little
+endian float64 lat, lon pairs next to its bbox, length in meters and whether it
+is closed. Queries and exports read one row per way instead of joining its nodes:
+
+    rows = connection.execute("select id, coords from way_geometry")
+    coords = unpack_coords(blob)   # [(lat, lon), ...]
+
+build_way_geometry fills the table after the load, osm_changes rebuilds the
+rows of the ways it changes (or whose nodes it changes). Both copy the bbox of
+the rows to the ways_rtree index of spatial.sql when the db has it, it is the
+only place the envelope of a way is computed.
+
+i.e python way_geometry.py dublin > ways.geojsonl
+'''
+import sys
+import json
+from array import array
+
+from osm_spatial import haversine
+
+GEOMETRY_TABLE = 'way_geometry'
+# rtree of spatial.sql holding a copy of the bbox of every way with points
+RTREE_TABLE = 'ways_rtree'
+# Rows fetched at a time from the ways_nodes scan and inserted at a time
+FETCH_SIZE = 10000
+BATCH_SIZE = 1000
+# Ids per "in (...)" of a partial rebuild, below the 999 variables of sqlite
+IDS_PER_QUERY = 500
+
+POINTS_SQL = '''
+select wn.id, wn.node_id, n.lat, n.lon
+  from ways_nodes wn left join nodes n on n.id = wn.node_id
+ {}
+ order by wn.id, wn.position
+'''
+ENVELOPES_SQL = '''INSERT INTO ways_rtree (id, min_lat, max_lat, min_lon, max_lon)
+                   SELECT id, min_lat, max_lat, min_lon, max_lon FROM way_geometry WHERE points > 0 {}'''
+INSERT_SQL = '''INSERT INTO way_geometry (id, coords, points, min_lat, min_lon, max_lat, max_lon, length_m, closed)
+                VALUES (?,?,?,?,?,?,?,?,?)'''
+
+
+def pack_coords(coords):
+    ''' return: blob of the (lat, lon) pairs as little endian float64'''
+    values = array('d', [value for point in coords for value in point])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return buffer(values.tostring())
+
+
+def unpack_coords(blob):
+    ''' return: list of (lat, lon) of a blob of pack_coords'''
+    values = array('d')
+    values.fromstring(str(blob))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return zip(values[0::2], values[1::2])
+
+
+def line_length(coords):
+    ''' return: meters along the (lat, lon) points'''
+    return sum(haversine(lat1, lon1, lat2, lon2) for (lat1, lon1), (lat2, lon2) in zip(coords, coords[1:]))
+
+
+def geometry_row(way_id, node_ids, coords):
+    ''' return: way_geometry row of the way
+        param: node_ids ids of the nodes of the way in position order
+        param: coords (lat, lon) of the nodes found in the db, in the same order
+    '''
+    closed = len(node_ids) > 2 and node_ids[0] == node_ids[-1]
+    if coords:
+        lats = [lat for lat, _ in coords]
+        lons = [lon for _, lon in coords]
+        bbox = (min(lats), min(lons), max(lats), max(lons))
+    else:
+        bbox = (None, None, None, None)
+    return (way_id, pack_coords(coords), len(coords)) + bbox + (line_length(coords), int(closed))
+
+
+def iter_geometry_rows(cursor, fetch_size=FETCH_SIZE):
+    ''' Yield the way_geometry row of every way of a POINTS_SQL cursor'''
+    current, node_ids, coords = None, [], []
+    while True:
+        batch = cursor.fetchmany(fetch_size)
+        if not batch:
+            break
+        for way_id, node_id, lat, lon in batch:
+            if way_id != current:
+                if current is not None:
+                    yield geometry_row(current, node_ids, coords)
+                current, node_ids, coords = way_id, [], []
+            node_ids.append(node_id)
+            if lat is not None and lon is not None:
+                coords.append((lat, lon))
+    if current is not None:
+        yield geometry_row(current, node_ids, coords)
+
+
+def insert_rows(connection, rows, batch_size=BATCH_SIZE):
+    ''' Insert the rows batch_size at a time
+        return: number of rows inserted
+    '''
+    count, batch = 0, []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            connection.executemany(INSERT_SQL, batch)
+            count, batch = count + len(batch), []
+    connection.executemany(INSERT_SQL, batch)
+    return count + len(batch)
+
+
+def has_rtree(connection):
+    ''' return: True if the db has the ways_rtree index of spatial.sql'''
+    return connection.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?",
+                              (RTREE_TABLE,)).fetchone()[0] > 0
+
+
+def build_way_geometry(connection, fetch_size=FETCH_SIZE):
+    ''' Fill the empty way_geometry table with every way, and ways_rtree with their bbox
+        if the db has it, it is not committed
+        return: number of ways
+    '''
+    cursor = connection.execute(POINTS_SQL.format(''))
+    # the rows are read on their own cursor while the inserts run on the connection
+    count = insert_rows(connection, iter_geometry_rows(cursor, fetch_size))
+    if has_rtree(connection):
+        connection.execute("DELETE FROM ways_rtree")
+        connection.execute(ENVELOPES_SQL.format(''))
+    return count
+
+
+def update_way_geometry(connection, way_ids, fetch_size=FETCH_SIZE):
+    ''' Rebuild the rows of way_ids and their ways_rtree envelope if the db has it,
+        the ways no longer in the db lose their row, it is not committed
+        return: number of ways rebuilt
+    '''
+    way_ids = sorted(way_ids)
+    rtree = has_rtree(connection)
+    count = 0
+    for start in xrange(0, len(way_ids), IDS_PER_QUERY):
+        ids = way_ids[start:start + IDS_PER_QUERY]
+        marks = ','.join('?' * len(ids))
+        connection.execute("DELETE FROM way_geometry WHERE id IN ({})".format(marks), ids)
+        # fetched before inserting, the scan must not see the new rows of the same ways
+        rows = list(iter_geometry_rows(connection.execute(POINTS_SQL.format("where wn.id in ({})".format(marks)), ids),
+                                       fetch_size))
+        count += insert_rows(connection, rows)
+        if rtree:
+            connection.execute("DELETE FROM ways_rtree WHERE id IN ({})".format(marks), ids)
+            connection.execute(ENVELOPES_SQL.format("AND id IN ({})".format(marks)), ids)
+    return count
+
+
+def way_feature(way_id, blob, closed):
+    ''' return: GeoJSON feature of a way_geometry row, a Polygon if closed else a LineString'''
+    line = [[lon, lat] for lat, lon in unpack_coords(blob)]
+    if closed and len(line) > 3:
+        geometry = { 'type': 'Polygon', 'coordinates': [line] }
+    else:
+        geometry = { 'type': 'LineString', 'coordinates': line }
+    return { 'type': 'Feature', 'id': way_id, 'geometry': geometry, 'properties': {} }
+
+
+def export_geojson(connection, out=sys.stdout):
+    ''' Write a GeoJSON feature per line for every way with points
+        return: number of ways written
+    '''
+    count = 0
+    for way_id, blob, closed in connection.execute("select id, coords, closed from way_geometry where points > 0"):
+        out.write(json.dumps(way_feature(way_id, blob, closed)) + '\n')
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    import sqlite3
+    connection = sqlite3.connect("{}.db".format(sys.argv[1] if len(sys.argv) > 1 else 'dublin'))
+    export_geojson(connection)